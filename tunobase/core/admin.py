@@ -44,6 +44,11 @@ class GalleryAdmin(admin.ModelAdmin, SiteListAdminMixin):
 class VersionAdmin(admin.ModelAdmin):
     list_display = ('content_type', 'object_id', 'series', 'number', 'state')
 
+
+class ScheduledTransitionAdmin(admin.ModelAdmin):
+    list_display = ('content_type', 'object_id', 'action', 'due_at')
+    list_filter = ('content_type', 'action')
+
 admin.site.register(models.ContentModel, ContentModelAdmin)
 admin.site.register(models.ContentBlock, ContentModelAdmin)
 admin.site.register(models.DefaultImage)
@@ -56,3 +61,4 @@ admin.site.register(models.GalleryImage)
 admin.site.register(models.Gallery, GalleryAdmin)
 admin.site.register(models.VersionSeries)
 admin.site.register(models.Version, VersionAdmin)
+admin.site.register(models.ScheduledTransition, ScheduledTransitionAdmin)
@@ -0,0 +1,161 @@
+'''
+CORE APP
+
+Shared cache helpers for version-resolved content.
+
+Cached content is keyed on a per-model generation number that is bumped
+whenever an object of the model, or one of its Version rows, changes.
+Bumping the generation orphans every entry cached for the model, so no
+entry ever needs to be deleted explicitly.
+
+'''
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import translation
+
+from tunobase.core import sites
+
+GENERATION_KEY = 'tunobase.core.generation.%s'
+SLUG_KEY = 'tunobase.core.slug.%s.%s.%s.%s.%s'
+FRAGMENT_KEY = 'tunobase.core.fragment.%s.%s.%s.%s.%s.%s'
+
+# Cached in place of objects that do not exist
+MISSING = 'tunobase.core.caching.missing'
+
+
+def _label(model):
+    opts = model._meta.concrete_model._meta
+    return '%s.%s' % (opts.app_label, opts.model_name)
+
+
+def _new_generation():
+    '''
+    Start generations from the clock so that an evicted generation
+    never restarts at a number that was used before
+    '''
+    return int(time.time() * 1000)
+
+
+def get_generation_stamp(*models):
+    '''
+    Return a string identifying the current generation of the given
+    models and their parent models
+    '''
+    labels = set()
+    for model in models:
+        labels.add(_label(model))
+        for parent in model._meta.get_parent_list():
+            labels.add(_label(parent))
+
+    keys = [GENERATION_KEY % label for label in sorted(labels)]
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            cache.add(key, _new_generation(), None)
+            generations[key] = cache.get(key)
+
+    return '-'.join(str(generations[key]) for key in keys)
+
+
+def bump_generation(model):
+    '''
+    Invalidate everything cached for the given model
+    '''
+    key = GENERATION_KEY % _label(model)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _new_generation(), None)
+
+
+def get_timeout():
+    return getattr(settings, 'CONTENT_CACHE_TIMEOUT', 60 * 15)
+
+
+def get_slug_cache_key(model, slug, site_id=None, stamp=None):
+    '''
+    Return the cache key of the permitted object of the given model with
+    the given slug on the current site
+    '''
+    if site_id is None:
+        site_id = sites.get_current_site().id
+    if stamp is None:
+        stamp = get_generation_stamp(model)
+
+    return SLUG_KEY % (
+        _label(model),
+        site_id,
+        int(bool(settings.STAGING)),
+        stamp,
+        hashlib.md5(slug.encode('utf-8')).hexdigest()
+    )
+
+
+def get_permitted_for_current_site(model, slug):
+    '''
+    Return the permitted object of the given model with the given slug
+    on the current site, or None if there is no such object. Missing
+    objects are cached too.
+    '''
+    key = get_slug_cache_key(model, slug)
+    obj = cache.get(key)
+    if obj is None:
+        try:
+            obj = model.objects.permitted().for_current_site().get(slug=slug)
+        except model.DoesNotExist:
+            obj = MISSING
+        cache.set(key, obj, get_timeout())
+
+    return None if obj == MISSING else obj
+
+
+def get_many_permitted_for_current_site(model, slugs):
+    '''
+    Return a dictionary mapping each of the given slugs to the permitted
+    object of the given model on the current site, or None. Slugs that
+    are not cached are resolved together with a single query.
+    '''
+    site_id = sites.get_current_site().id
+    stamp = get_generation_stamp(model)
+    keys = dict(
+        (get_slug_cache_key(model, slug, site_id, stamp), slug)
+        for slug in slugs
+    )
+
+    found = dict(
+        (keys[key], obj) for key, obj in cache.get_many(keys.keys()).items()
+    )
+    missing = [slug for slug in slugs if slug not in found]
+    if missing:
+        queryset = model.objects.permitted().for_current_site()\
+            .filter(slug__in=missing)
+        for obj in queryset:
+            found.setdefault(obj.slug, obj)
+        cache.set_many(dict(
+            (get_slug_cache_key(model, slug, site_id, stamp),
+                found.setdefault(slug, MISSING))
+            for slug in missing
+        ), get_timeout())
+
+    return dict(
+        (slug, None if obj == MISSING else obj)
+        for slug, obj in found.items()
+    )
+
+
+def get_fragment_cache_key(template_name, obj, *member_models):
+    '''
+    Return the cache key of a fragment rendered for the given object
+    and its members on the current site
+    '''
+    return FRAGMENT_KEY % (
+        hashlib.md5(template_name).hexdigest(),
+        '%s-%s' % (_label(obj), obj.pk),
+        sites.get_current_site().id,
+        int(bool(settings.STAGING)),
+        translation.get_language(),
+        get_generation_stamp(obj.__class__, *member_models)
+    )
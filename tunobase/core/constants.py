@@ -14,4 +14,12 @@ STATE_CHOICES = (
     (STATE_DELETED, 'Deleted'),
 )
 
-PERMITTED_STATE = [STATE_PUBLISHED, STATE_STAGED]
\ No newline at end of file
+PERMITTED_STATE = [STATE_PUBLISHED, STATE_STAGED]
+
+TRANSITION_PUBLISH = 0
+TRANSITION_RETRACT = 1
+
+TRANSITION_CHOICES = (
+    (TRANSITION_PUBLISH, 'Publish'),
+    (TRANSITION_RETRACT, 'Retract'),
+)
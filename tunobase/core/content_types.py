@@ -0,0 +1,142 @@
+'''
+CORE APP
+
+Process-local and shared cache of ContentType ids.
+
+The versioning layer and the tagging app resolve a ContentType for
+nearly every query they build. This module keeps an immutable map of
+(app_label, model) to content type id per process, loaded in full the
+first time it is needed, either from the shared cache or with a single
+query. A miss (a content type created after the map was loaded) falls
+back to Django's ContentType manager and replaces the map with an
+extended copy.
+
+'''
+from django.core.cache import cache
+from django.contrib.contenttypes.models import ContentType
+from django.core.signals import request_started
+from django.db.models.signals import post_save, post_delete, post_syncdb
+
+from south.signals import post_migrate
+
+CACHE_KEY = 'tunobase.core.content_type_ids'
+
+# Replaced, never mutated, so readers never observe a partial map
+_ids = None
+_misses = 0
+
+
+def _load():
+    '''
+    Load the full map from the shared cache or the database
+    '''
+    global _ids
+
+    ids = cache.get(CACHE_KEY)
+    if ids is None:
+        ids = dict(
+            ((app_label, model), pk) for pk, app_label, model in
+            ContentType.objects.values_list('pk', 'app_label', 'model')
+        )
+        cache.set(CACHE_KEY, ids, None)
+    _ids = ids
+    return ids
+
+
+def _lookup(key, resolve):
+    '''
+    Return the id for key, resolving and recording it on a miss
+    '''
+    global _ids, _misses
+
+    ids = _ids if _ids is not None else _load()
+    try:
+        return ids[key]
+    except KeyError:
+        _misses += 1
+        pk = resolve().pk
+        ids = dict(ids)
+        ids[key] = pk
+        _ids = ids
+        cache.set(CACHE_KEY, ids, None)
+        return pk
+
+
+def warm():
+    '''
+    Load the map ahead of the first lookup
+    '''
+    _load()
+
+
+def warm_on_startup(**kwargs):
+    '''
+    Load the map when a process serves its first request, so that no
+    request pays for a lookup miss. Django 1.6 has no application ready
+    hook, and loading at import time would query the database from
+    every management command, including syncdb and migrate.
+    '''
+    request_started.disconnect(
+        warm_on_startup,
+        dispatch_uid='tunobase.core.content_types.warm'
+    )
+    if _ids is None:
+        warm()
+
+
+def get_id_for_model(model):
+    '''
+    Return the content type id of a model class or instance, following
+    ContentType.objects.get_for_model in using the concrete model
+    '''
+    opts = model._meta.concrete_model._meta
+    return _lookup(
+        (opts.app_label, opts.model_name),
+        lambda: ContentType.objects.get_for_model(model)
+    )
+
+
+def get_id_by_natural_key(app_label, model):
+    '''
+    Return the content type id for an (app_label, model) natural key
+    '''
+    return _lookup(
+        (app_label, model),
+        lambda: ContentType.objects.get_by_natural_key(app_label, model)
+    )
+
+
+def get_miss_count():
+    '''
+    Return the number of lookups this process had to resolve
+    '''
+    return _misses
+
+
+def invalidate(**kwargs):
+    '''
+    Drop the process-local and shared maps so that the next lookup
+    reloads them. Connected to migrations and content type changes.
+    '''
+    global _ids
+
+    _ids = None
+    cache.delete(CACHE_KEY)
+
+
+post_syncdb.connect(invalidate, dispatch_uid='tunobase.core.content_types')
+post_migrate.connect(invalidate, dispatch_uid='tunobase.core.content_types')
+post_save.connect(
+    invalidate,
+    sender=ContentType,
+    dispatch_uid='tunobase.core.content_types'
+)
+post_delete.connect(
+    invalidate,
+    sender=ContentType,
+    dispatch_uid='tunobase.core.content_types'
+)
+request_started.connect(
+    warm_on_startup,
+    dispatch_uid='tunobase.core.content_types.warm'
+)
@@ -0,0 +1,28 @@
+'''
+CORE APP
+
+Check the live version pointers against the Version table.
+
+'''
+from django.core.management.base import BaseCommand, CommandError
+
+from tunobase.core import models
+
+
+class Command(BaseCommand):
+    """
+    Compare the live version pointers against the Version table.
+    """
+    def handle(self, *args, **options):
+        inconsistencies = models.LiveVersion.objects.check_consistency()
+        for series_id, expected, actual in inconsistencies:
+            print 'Series %s: expected %s, found %s' % (
+                series_id, expected, actual
+            )
+
+        if inconsistencies:
+            raise CommandError(
+                '%s inconsistent live version pointers, '
+                'run rebuild_live_versions to fix them' % len(inconsistencies)
+            )
+        print 'All live version pointers are consistent'
@@ -0,0 +1,18 @@
+'''
+CORE APP
+
+Rebuild the live version pointers from the Version table.
+
+'''
+from django.core.management.base import BaseCommand
+
+from tunobase.core import models
+
+
+class Command(BaseCommand):
+    """
+    Rebuild the series to displayed version pointers used by get_list().
+    """
+    def handle(self, *args, **options):
+        count = models.LiveVersion.objects.rebuild()
+        print 'Rebuilt %s live version pointers' % count
@@ -0,0 +1,19 @@
+'''
+CORE APP
+
+Schedule the publish and retract times of existing objects.
+
+'''
+from django.core.management.base import BaseCommand
+
+from tunobase.core import models
+
+
+class Command(BaseCommand):
+    """
+    Record the upcoming publish and retract times of every StateModel
+    object and wake the scheduler worker for the earliest one.
+    """
+    def handle(self, *args, **options):
+        count = models.ScheduledTransition.objects.rebuild()
+        print 'Scheduled transitions for %s objects' % count
@@ -4,7 +4,12 @@ CORE APP
 This module provides an interface to the app's managers.
 
 """
-from django.db import models
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import Q
 from django.utils import timezone
 from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
@@ -12,28 +17,399 @@ from django.template.defaultfilters import slugify
 
 # from polymorphic import PolymorphicManager
 
-from tunobase.core import constants, query
+from tunobase.core import caching, constants, content_types, query
+
+
+def _batches(items, size):
+    """Yield successive slices of at most size items."""
+
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
 
 # Normal managers
 
 
 class VersionManager(models.Manager):
 
+    # Maximum number of ids passed to a single ``IN`` clause
+    batch_size = 500
+
     def publish_objects(self):
-        """Return only published objects."""
+        """
+        Publish every due version whose series has no published version,
+        leaving out objects whose retract_at has passed.
+
+        Due versions are found per content type with a handful of set based
+        queries, then the Version and content rows are flipped with batched
+        updates inside a transaction. Note that, as with any bulk update,
+        the content models' save() methods and signals are not invoked.
+
+        Return a dictionary keyed by model label holding the number of
+        versions and objects published and the time taken in seconds.
+        """
+        from tunobase.core.models import LiveVersion
+
+        now = timezone.now()
+        published_series_ids = self.filter(
+            state=constants.STATE_PUBLISHED
+        ).values('series_id')
+        pending = self.exclude(state=constants.STATE_PUBLISHED)\
+            .exclude(series_id__in=published_series_ids)
+        content_type_ids = pending.order_by()\
+            .values_list('content_type_id', flat=True).distinct()
+
+        results = {}
+        for content_type_id in list(content_type_ids):
+            started = time.time()
+            model = ContentType.objects.get_for_id(content_type_id)\
+                .model_class()
+            if model is None:
+                continue
+
+            with transaction.atomic():
+                versions = list(pending.filter(
+                    content_type_id=content_type_id
+                ).values_list('pk', 'series_id', 'object_id'))
+                object_ids = set(version[2] for version in versions)
+
+                # An empty publish_at has always counted as due
+                due_object_ids = set()
+                for batch in _batches(list(object_ids), self.batch_size):
+                    due_object_ids.update(model._default_manager.filter(
+                        Q(publish_at__lte=now) | Q(publish_at__isnull=True),
+                        pk__in=batch
+                    ).exclude(
+                        retract_at__lte=now
+                    ).values_list('pk', flat=True))
+
+                due_versions = [
+                    version for version in versions
+                    if version[2] in due_object_ids
+                ]
+                for batch in _batches(due_versions, self.batch_size):
+                    self.filter(
+                        pk__in=[version[0] for version in batch]
+                    ).update(state=constants.STATE_PUBLISHED)
+                for batch in _batches(list(due_object_ids), self.batch_size):
+                    model._default_manager.filter(pk__in=batch)\
+                        .update(state=constants.STATE_PUBLISHED)
+
+                LiveVersion.objects.point_to_published(
+                    content_type_id,
+                    due_versions,
+                    self.batch_size
+                )
+
+            if due_versions:
+                caching.bump_generation(model)
+
+            results[u'%s.%s' % (
+                model._meta.app_label, model._meta.object_name
+            )] = {
+                'versions': len(due_versions),
+                'objects': len(due_object_ids),
+                'seconds': time.time() - started,
+            }
+
+        return results
+
+
+class LiveVersionManager(models.Manager):
+    """Maintain the series to displayed version pointers."""
+
+    # Order of preference when choosing which version of a series
+    # is displayed in listings
+    states = (
+        query.CoreStateQuerySet.STATE,
+        query.CoreStateQuerySet.NEXT_STATE,
+        query.CoreStateQuerySet.BOTTOM_STATE,
+    )
+
+    def _choose(self, versions):
+        """
+        Return the preferred (pk, content_type_id, object_id, state)
+        tuple from the given versions of a single series.
+        """
+        chosen = None
+        for version in versions:
+            if chosen is None or self.states.index(version[3]) < \
+                    self.states.index(chosen[3]):
+                chosen = version
+        return chosen
+
+    def _expected(self):
+        """
+        Yield (series_id, version_id, content_type_id, object_id) for
+        every series that has a displayable version.
+        """
+        from tunobase.core.models import Version
+        rows = Version.objects.filter(state__in=self.states)\
+            .order_by('series', 'pk')\
+            .values_list(
+                'series_id', 'pk', 'content_type_id', 'object_id', 'state'
+            ).iterator()
+
+        series_id = None
+        versions = []
+        for row in rows:
+            if row[0] != series_id:
+                if versions:
+                    yield (series_id,) + self._choose(versions)[:3]
+                series_id = row[0]
+                versions = []
+            versions.append(row[1:])
+        if versions:
+            yield (series_id,) + self._choose(versions)[:3]
+
+    def point_to_published(self, content_type_id, versions, batch_size=500):
+        """
+        Point each series at its newly published version, given as
+        (pk, series_id, object_id) tuples of series that had no published
+        version before, with batched deletes and one bulk insert.
+        """
+        # As in _choose, the first published version of a series wins
+        chosen = {}
+        for version in sorted(versions):
+            chosen.setdefault(version[1], version)
+
+        with transaction.atomic():
+            for batch in _batches(list(chosen), batch_size):
+                self.filter(series_id__in=batch).delete()
+            self.bulk_create([
+                self.model(
+                    series_id=series_id,
+                    version_id=version_id,
+                    content_type_id=content_type_id,
+                    object_id=object_id
+                )
+                for series_id, (version_id, _, object_id) in chosen.items()
+            ], batch_size=batch_size)
+
+    def refresh(self, series_id):
+        """Point the series at the version it should currently display."""
+        from tunobase.core.models import Version
+        with transaction.atomic():
+            chosen = self._choose(Version.objects.filter(
+                series_id=series_id,
+                state__in=self.states
+            ).order_by('pk').values_list(
+                'pk', 'content_type_id', 'object_id', 'state'
+            ))
+
+            if chosen is None:
+                self.filter(series_id=series_id).delete()
+                return
+
+            updated = self.filter(series_id=series_id).update(
+                version=chosen[0],
+                content_type=chosen[1],
+                object_id=chosen[2]
+            )
+            if not updated:
+                self.create(
+                    series_id=series_id,
+                    version_id=chosen[0],
+                    content_type_id=chosen[1],
+                    object_id=chosen[2]
+                )
 
-        queryset = self.exclude(state=constants.STATE_PUBLISHED)
-        to_publish_ids = []
-        for obj in queryset:
-            published_obj = obj.series.versions.filter(
-                state=constants.STATE_PUBLISHED
-            ).exists()
-            if not published_obj and obj.content_object.publish_at <= timezone.now():
-                to_publish_ids.append(obj.pk)
-                obj.content_object.state = constants.STATE_PUBLISHED
-                obj.content_object.save()
-        update_queryset = self.filter(pk__in=to_publish_ids)
-        update_queryset.update(state=constants.STATE_PUBLISHED)
+    def rebuild(self, batch_size=1000):
+        """Recreate every pointer from the Version table."""
+
+        with transaction.atomic():
+            self.all().delete()
+            batch = []
+            count = 0
+            for series_id, version_id, content_type_id, object_id \
+                    in self._expected():
+                batch.append(self.model(
+                    series_id=series_id,
+                    version_id=version_id,
+                    content_type_id=content_type_id,
+                    object_id=object_id
+                ))
+                if len(batch) >= batch_size:
+                    self.bulk_create(batch)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                self.bulk_create(batch)
+                count += len(batch)
+
+        return count
+
+    def check_consistency(self):
+        """
+        Return a list of (series_id, expected, actual) tuples for every
+        pointer that does not match the Version table, where expected and
+        actual are (version_id, content_type_id, object_id) tuples or None
+        if the pointer should not or does not exist.
+        """
+        actual = dict(
+            (row[0], row[1:]) for row in self.values_list(
+                'series_id', 'version_id', 'content_type_id', 'object_id'
+            ).iterator()
+        )
+        inconsistencies = []
+        for row in self._expected():
+            series_id, expected = row[0], row[1:]
+            actual_pointer = actual.pop(series_id, None)
+            if actual_pointer != expected:
+                inconsistencies.append((series_id, expected, actual_pointer))
+        for series_id, actual_pointer in actual.items():
+            inconsistencies.append((series_id, None, actual_pointer))
+
+        return sorted(inconsistencies)
+
+
+class ScheduledTransitionManager(models.Manager):
+    """Keep track of upcoming publish and retract times."""
+
+    # Cache key holding the time the scheduler worker is due to wake up
+    wakeup_cache_key = 'tunobase.core.scheduled_transitions.wakeup'
+
+    def schedule(self, obj):
+        """Record the upcoming transitions of a StateModel object."""
+
+        now = timezone.now()
+        content_type_id = content_types.get_id_for_model(obj)
+        transitions = []
+        if obj.state != constants.STATE_DELETED:
+            if obj.state != constants.STATE_PUBLISHED \
+                    and obj.publish_at and obj.publish_at > now:
+                transitions.append(self.model(
+                    content_type_id=content_type_id,
+                    object_id=obj.pk,
+                    action=constants.TRANSITION_PUBLISH,
+                    due_at=obj.publish_at
+                ))
+            if obj.retract_at and obj.retract_at > now:
+                transitions.append(self.model(
+                    content_type_id=content_type_id,
+                    object_id=obj.pk,
+                    action=constants.TRANSITION_RETRACT,
+                    due_at=obj.retract_at
+                ))
+
+        with transaction.atomic():
+            self.filter(
+                content_type=content_type_id,
+                object_id=obj.pk
+            ).delete()
+            if transitions:
+                self.bulk_create(transitions)
+
+        if transitions:
+            self.wake_up_at(min(t.due_at for t in transitions))
+
+    def wake_up_at(self, due_at):
+        """
+        Make sure the scheduler worker runs at due_at unless it is
+        already due to run earlier. A wake up time in the past is treated
+        as lost so that a dropped task cannot stall the schedule.
+        """
+        from tunobase.core import tasks
+
+        now = timezone.now()
+        # Eagerly executed tasks ignore their eta and cannot sleep
+        if getattr(settings, 'CELERY_ALWAYS_EAGER', False) and due_at > now:
+            return
+
+        wakeup = cache.get(self.wakeup_cache_key)
+        if wakeup is None or wakeup <= now or due_at < wakeup:
+            cache.set(self.wakeup_cache_key, due_at, None)
+            tasks.apply_scheduled_transitions.apply_async(
+                (due_at,), eta=due_at
+            )
+
+    def next_due(self):
+        """Return the time of the earliest scheduled transition."""
+
+        try:
+            return self.order_by('due_at').values_list(
+                'due_at', flat=True
+            )[0]
+        except IndexError:
+            return None
+
+    def apply_due(self, now=None):
+        """
+        Apply every transition that is due and return the number applied.
+        Versioned objects go through publish_version/unpublish_version,
+        other objects have their state updated in bulk. The due
+        transitions are locked and deleted in the transaction that applies
+        them, so that overlapping workers cannot apply one twice.
+        """
+        from tunobase.core.models import Version
+
+        if now is None:
+            now = timezone.now()
+
+        changed_models = set()
+        with transaction.atomic():
+            due = list(self.select_for_update().filter(
+                due_at__lte=now
+            ).values_list('pk', 'content_type_id', 'object_id', 'action'))
+            self.filter(pk__in=[transition[0] for transition in due])\
+                .delete()
+
+            groups = {}
+            for pk, content_type_id, object_id, action in due:
+                groups.setdefault(
+                    (content_type_id, action), []
+                ).append(object_id)
+
+            for (content_type_id, action), object_ids in groups.items():
+                model = ContentType.objects.get_for_id(content_type_id)\
+                    .model_class()
+                if model is None:
+                    continue
+                manager = model._default_manager
+                if action == constants.TRANSITION_PUBLISH:
+                    state = constants.STATE_PUBLISHED
+                    version_method = 'publish_version'
+                else:
+                    state = constants.STATE_UNPUBLISHED
+                    version_method = 'unpublish_version'
+
+                versioned_ids = set()
+                if hasattr(manager, version_method):
+                    versioned_ids.update(Version.objects.filter(
+                        content_type_id=content_type_id,
+                        object_id__in=object_ids
+                    ).values_list('object_id', flat=True))
+                for object_id in versioned_ids:
+                    getattr(manager, version_method)(object_id)
+
+                manager.filter(
+                    pk__in=[pk for pk in object_ids if pk not in versioned_ids]
+                ).exclude(
+                    state=constants.STATE_DELETED
+                ).update(state=state)
+                changed_models.add(model)
+
+        for model in changed_models:
+            caching.bump_generation(model)
+        return len(due)
+
+    def rebuild(self):
+        """Schedule the transitions of every StateModel object."""
+        from tunobase.core.models import StateModel
+
+        now = timezone.now()
+        count = 0
+        for model in models.get_models():
+            if not issubclass(model, StateModel):
+                continue
+            queryset = model._default_manager.filter(
+                Q(publish_at__gt=now) | Q(retract_at__gt=now)
+            ).exclude(state=constants.STATE_DELETED)
+            for obj in queryset.iterator():
+                self.schedule(obj)
+                count += 1
+
+        return count
 
 
 class CoreManager(models.Manager):
@@ -60,11 +436,15 @@ class CoreStateManager(CoreManager):
     def publish_objects(self):
         """Return only published objects."""
 
+        now = timezone.now()
         queryset = self.permitted().filter(
-            publish_at__lte=timezone.now()
-        ).exclude(state=constants.STATE_PUBLISHED)
+            publish_at__lte=now
+        ).exclude(
+            state=constants.STATE_PUBLISHED
+        ).exclude(retract_at__lte=now)
 
-        queryset.update(state=constants.STATE_PUBLISHED)
+        if queryset.update(state=constants.STATE_PUBLISHED):
+            caching.bump_generation(self.model)
 
     def permitted(self):
         """Only return publised objects."""
@@ -91,10 +471,10 @@ class CoreStateManager(CoreManager):
 
     def get_series(self, object_id):
         from tunobase.core.models import Version
-        model_type = ContentType.objects.get_for_model(self.model)
+        content_type_id = content_types.get_id_for_model(self.model)
         try:
             return Version.objects.get(
-                content_type__pk=model_type.id,
+                content_type=content_type_id,
                 object_id=object_id
             ).series
         except:
@@ -107,20 +487,22 @@ class CoreStateManager(CoreManager):
         )
 
     def add_version(self, obj):
-        from tunobase.core.models import Version
-        model_type = ContentType.objects.get_for_model(self.model)
-        series = self.add_series(slugify(str(obj)))
-        Version.objects.create(
-            content_type=model_type,
-            object_id=obj.pk,
-            series=series,
-            number=1,
-            state=obj.state
-        )
+        from tunobase.core.models import Version, LiveVersion
+        content_type_id = content_types.get_id_for_model(self.model)
+        with transaction.atomic():
+            series = self.add_series(slugify(str(obj)))
+            Version.objects.create(
+                content_type_id=content_type_id,
+                object_id=obj.pk,
+                series=series,
+                number=1,
+                state=obj.state
+            )
+            LiveVersion.objects.refresh(series.pk)
 
     def add_to_series(self, series, obj):
-        from tunobase.core.models import Version
-        model_type = ContentType.objects.get_for_model(self.model)
+        from tunobase.core.models import Version, LiveVersion
+        content_type_id = content_types.get_id_for_model(self.model)
         try:
             latest_version_number = Version.objects.filter(
                 series=series
@@ -128,88 +510,100 @@ class CoreStateManager(CoreManager):
         except:
             latest_version_number = 1
 
-        Version.objects.create(
-            content_type=model_type,
-            object_id=obj.pk,
-            series=series,
-            number=latest_version_number,
-            state=constants.STATE_UNPUBLISHED
-        )
+        with transaction.atomic():
+            Version.objects.create(
+                content_type_id=content_type_id,
+                object_id=obj.pk,
+                series=series,
+                number=latest_version_number,
+                state=constants.STATE_UNPUBLISHED
+            )
+            LiveVersion.objects.refresh(series.pk)
 
     def stage_version(self, object_id):
-        from tunobase.core.models import Version
+        from tunobase.core.models import Version, LiveVersion
         series = self.get_series(object_id)
-        model_type = ContentType.objects.get_for_model(self.model)
-        if series is not None and Version.objects.filter(
-                series=series, state=constants.STATE_STAGED).exists():
-            staged_version = Version.objects.get(
-                series=series,
-                state=constants.STATE_STAGED
+        content_type_id = content_types.get_id_for_model(self.model)
+        with transaction.atomic():
+            if series is not None and Version.objects.filter(
+                    series=series, state=constants.STATE_STAGED).exists():
+                staged_version = Version.objects.get(
+                    series=series,
+                    state=constants.STATE_STAGED
+                )
+                staged_version.state = constants.STATE_UNPUBLISHED
+                staged_version.save()
+                staged_version.content_object.state = \
+                    constants.STATE_UNPUBLISHED
+                staged_version.content_object.save()
+
+            version = Version.objects.get(
+                content_type=content_type_id,
+                object_id=object_id
             )
-            staged_version.state = constants.STATE_UNPUBLISHED
-            staged_version.save()
-            staged_version.content_object.state = constants.STATE_UNPUBLISHED
-            staged_version.content_object.save()
-
-        version = Version.objects.get(
-            content_type__pk=model_type.id,
-            object_id=object_id
-        )
-        version.state = constants.STATE_STAGED
-        version.save()
-        version.content_object.state = constants.STATE_STAGED
-        version.content_object.save()
+            version.state = constants.STATE_STAGED
+            version.save()
+            version.content_object.state = constants.STATE_STAGED
+            version.content_object.save()
+            LiveVersion.objects.refresh(version.series_id)
 
     def publish_version(self, object_id):
-        from tunobase.core.models import Version
+        from tunobase.core.models import Version, LiveVersion
         series = self.get_series(object_id)
-        model_type = ContentType.objects.get_for_model(self.model)
-
-        if series is not None and Version.objects.filter(
-                series=series, state=constants.STATE_PUBLISHED).exists():
-            published_version = Version.objects.get(
-                series=series,
-                state=constants.STATE_PUBLISHED
+        content_type_id = content_types.get_id_for_model(self.model)
+
+        with transaction.atomic():
+            if series is not None and Version.objects.filter(
+                    series=series, state=constants.STATE_PUBLISHED).exists():
+                published_version = Version.objects.get(
+                    series=series,
+                    state=constants.STATE_PUBLISHED
+                )
+                published_version.state = constants.STATE_UNPUBLISHED
+                published_version.save()
+                published_version.content_object.state = \
+                    constants.STATE_UNPUBLISHED
+                published_version.content_object.save()
+            version = Version.objects.get(
+                content_type=content_type_id,
+                object_id=object_id
             )
-            published_version.state = constants.STATE_UNPUBLISHED
-            published_version.save()
-            published_version.content_object.state = constants.STATE_UNPUBLISHED
-            published_version.content_object.save()
-        version = Version.objects.get(
-            content_type__pk=model_type.id,
-            object_id=object_id
-        )
-        version.state = constants.STATE_PUBLISHED
-        version.save()
-        version.content_object.state = constants.STATE_PUBLISHED
-        version.content_object.save()
+            version.state = constants.STATE_PUBLISHED
+            version.save()
+            version.content_object.state = constants.STATE_PUBLISHED
+            version.content_object.save()
+            LiveVersion.objects.refresh(version.series_id)
 
     def unpublish_version(self, object_id):
-        from tunobase.core.models import Version
-        model_type = ContentType.objects.get_for_model(self.model)
+        from tunobase.core.models import Version, LiveVersion
+        content_type_id = content_types.get_id_for_model(self.model)
 
-        version = Version.objects.get(
-            content_type__pk=model_type.id,
-            object_id=object_id
-        )
-        version.state = constants.STATE_UNPUBLISHED
-        version.save()
-        version.content_object.state = constants.STATE_UNPUBLISHED
-        version.content_object.publish_date_time = timezone.now()
-        version.content_object.save()
+        with transaction.atomic():
+            version = Version.objects.get(
+                content_type=content_type_id,
+                object_id=object_id
+            )
+            version.state = constants.STATE_UNPUBLISHED
+            version.save()
+            version.content_object.state = constants.STATE_UNPUBLISHED
+            version.content_object.publish_date_time = timezone.now()
+            version.content_object.save()
+            LiveVersion.objects.refresh(version.series_id)
 
     def delete_version(self, object_id):
-        from tunobase.core.models import Version
-        model_type = ContentType.objects.get_for_model(self.model)
+        from tunobase.core.models import Version, LiveVersion
+        content_type_id = content_types.get_id_for_model(self.model)
 
-        version = Version.objects.get(
-            content_type__pk=model_type.id,
-            object_id=object_id
-        )
-        version.state = constants.STATE_DELETED
-        version.save()
-        version.content_object.state = constants.STATE_DELETED
-        version.content_object.save()
+        with transaction.atomic():
+            version = Version.objects.get(
+                content_type=content_type_id,
+                object_id=object_id
+            )
+            version.state = constants.STATE_DELETED
+            version.save()
+            version.content_object.state = constants.STATE_DELETED
+            version.content_object.save()
+            LiveVersion.objects.refresh(version.series_id)
 
 
 # # Polymorphic Managers
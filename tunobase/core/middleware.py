@@ -0,0 +1,40 @@
+"""
+CORE APP
+
+This module provides the core app's middleware.
+
+"""
+from django.conf import settings
+from django.contrib.sites.models import Site
+
+from tunobase.core import sites
+
+
+class CurrentSiteMiddleware(object):
+    """
+    Resolve the current site once per request and share it through
+    tunobase.core.sites. When SITE_FROM_REQUEST_HOST is True the site is
+    looked up by the request's host, otherwise SITE_ID is used.
+    """
+
+    def process_request(self, request):
+        """Set the current site for the request."""
+
+        if getattr(settings, 'SITE_FROM_REQUEST_HOST', False):
+            site = sites.get_site_for_host(request.get_host())
+        else:
+            site = Site.objects.get_current()
+
+        sites.set_current_site(site)
+        request.site = site
+
+    def process_response(self, request, response):
+        """Clear the current site once the response is ready."""
+
+        sites.clear_current_site()
+        return response
+
+    def process_exception(self, request, exception):
+        """Clear the current site when the view fails."""
+
+        sites.clear_current_site()
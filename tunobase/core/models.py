@@ -10,6 +10,7 @@ from django.conf import settings
 from django.contrib.sites.models import Site
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.template.defaultfilters import slugify
 from django.utils import timezone
 from django.contrib.contenttypes import generic
@@ -20,7 +21,7 @@ from photologue.models import ImageModel as PhotologueImageModel
 
 from redactor.fields import RedactorTextField
 
-from tunobase.core import constants, managers
+from tunobase.core import caching, constants, content_types, managers
 
 
 class StateModel(models.Model):
@@ -41,6 +42,26 @@ class StateModel(models.Model):
         ordering = ['-publish_at']
         abstract = True
 
+    def __init__(self, *args, **kwargs):
+        super(StateModel, self).__init__(*args, **kwargs)
+        self._saved_schedule = self._get_schedule() \
+                if self.pk is not None else None
+
+    def _get_schedule(self):
+        '''
+        Return the values the scheduled transitions of the object depend on,
+        without loading deferred fields
+        '''
+        return tuple(
+            self.__dict__.get(name)
+            for name in ('state', 'publish_at', 'retract_at')
+        )
+
+    def _has_future_transition(self, schedule, now):
+        return schedule is not None and any(
+            at is not None and at > now for at in schedule[1:]
+        )
+
     def mark_deleted(self):
         self.state = constants.STATE_DELETED
         self.save()
@@ -51,6 +72,16 @@ class StateModel(models.Model):
 
         super(StateModel, self).save(*args, **kwargs)
 
+        # Only reschedule when the schedule changed and there is, or was,
+        # a transition to come
+        schedule = self._get_schedule()
+        if schedule != self._saved_schedule:
+            now = timezone.now()
+            if self._has_future_transition(schedule, now) or \
+                    self._has_future_transition(self._saved_schedule, now):
+                ScheduledTransition.objects.schedule(self)
+        self._saved_schedule = schedule
+
 
 class SlugModel(models.Model):
     '''
@@ -177,7 +208,9 @@ class ContentModel(BaseContentModel):
         return self.leaf_content_type.model_class().objects.get(id=self.id)
 
     def save(self, *args, **kwargs):
-        self.leaf_content_type = ContentType.objects.get_for_model(self.__class__) if not self.leaf_content_type else self.leaf_content_type
+        if not self.leaf_content_type_id:
+            self.leaf_content_type_id = \
+                content_types.get_id_for_model(self.__class__)
         return super(ContentModel, self).save(*args, **kwargs)
 
     def __unicode__(self):
@@ -339,5 +372,89 @@ class Version(models.Model):
     )
     objects = managers.VersionManager()
 
+    class Meta:
+        index_together = [['content_type', 'state', 'object_id']]
+
     def __unicode__(self):
         return u'%s' % self.series
+
+
+class LiveVersion(models.Model):
+    '''
+    Denormalised pointer from a VersionSeries to the Version that
+    is currently displayed in listings
+    '''
+    series = models.OneToOneField(
+        VersionSeries,
+        primary_key=True,
+        related_name='live_version'
+    )
+    version = models.ForeignKey(Version, related_name='+')
+    content_type = models.ForeignKey(ContentType, related_name='+')
+    object_id = models.PositiveIntegerField()
+
+    objects = managers.LiveVersionManager()
+
+    class Meta:
+        index_together = [['content_type', 'object_id']]
+
+    def __unicode__(self):
+        return u'%s' % self.series
+
+
+class ScheduledTransition(models.Model):
+    '''
+    An upcoming publish or retract of a StateModel object
+    '''
+    content_type = models.ForeignKey(ContentType, related_name='+')
+    object_id = models.PositiveIntegerField()
+    content_object = generic.GenericForeignKey('content_type', 'object_id')
+    action = models.PositiveSmallIntegerField(
+        choices=constants.TRANSITION_CHOICES
+    )
+    due_at = models.DateTimeField(db_index=True)
+
+    objects = managers.ScheduledTransitionManager()
+
+    class Meta:
+        ordering = ['due_at']
+        unique_together = [('content_type', 'object_id', 'action')]
+
+    def __unicode__(self):
+        return u'%s %s at %s' % (
+            self.get_action_display(), self.content_object, self.due_at
+        )
+
+
+def invalidate_state_model_cache(sender, **kwargs):
+    '''
+    Invalidate cached content when a StateModel object changes
+    '''
+    if issubclass(sender, StateModel):
+        caching.bump_generation(sender)
+
+
+def invalidate_version_cache(sender, instance, **kwargs):
+    '''
+    Invalidate cached content when one of its Version rows changes
+    '''
+    model = ContentType.objects.get_for_id(instance.content_type_id)\
+        .model_class()
+    if model is not None:
+        caching.bump_generation(model)
+
+
+def invalidate_m2m_cache(sender, instance, model, **kwargs):
+    '''
+    Invalidate cached content when its sites or members change
+    '''
+    for changed_model in (instance.__class__, model):
+        if issubclass(changed_model, StateModel):
+            caching.bump_generation(changed_model)
+
+
+post_save.connect(invalidate_state_model_cache)
+post_delete.connect(invalidate_state_model_cache)
+post_save.connect(invalidate_version_cache, sender=Version)
+post_delete.connect(invalidate_version_cache, sender=Version)
+m2m_changed.connect(invalidate_m2m_cache)
@@ -4,11 +4,46 @@ CORE APP
 This module provides an interface into nodes.
 
 """
-from django.template import Node, Variable
+from django.template import Node, Variable, TOKEN_BLOCK
 from django.utils.encoding import smart_unicode
 from django.template import VariableDoesNotExist
 
-from tunobase.core import utils
+from tunobase.core import caching, models, utils
+
+# Tags whose first argument is the slug of a content block
+CONTENT_BLOCK_TAGS = ('content_block_widget', 'content_block_plain')
+
+
+def get_preloaded_content_blocks(context):
+    """
+    Return the slug to content block mapping shared by the current
+    request, or by the current render if there is no request.
+    """
+    request = context.get('request')
+    if request is not None:
+        if not hasattr(request, '_preloaded_content_blocks'):
+            request._preloaded_content_blocks = {}
+        return request._preloaded_content_blocks
+
+    return context.dicts[0].setdefault('_preloaded_content_blocks', {})
+
+
+def find_content_block_slugs(tokens):
+    """
+    Return the slug arguments of the content block tags in the given
+    template tokens.
+    """
+    slugs = []
+    for token in tokens:
+        if token.token_type != TOKEN_BLOCK:
+            continue
+        bits = token.split_contents()
+        if len(bits) > 1 and bits[0] in CONTENT_BLOCK_TAGS \
+                and bits[1] not in slugs:
+            slugs.append(bits[1])
+
+    return slugs
+
 
 class BreadcrumbNode(Node):
     def __init__(self, vars):
@@ -92,3 +127,30 @@ class SmartQueryStringNode(Node):
                     q.pop(key, None)
             qs = '&'.join(['%s=%s' % (k, v) for k, v in q.items()])
         return '?' + qs if len(q) else ''
+
+
+class PreloadContentBlocksNode(Node):
+    """Resolve a list of content blocks with a single query."""
+
+    def __init__(self, slugs):
+        """Initialise variables."""
+
+        self.slugs = slugs
+
+    def render(self, context):
+        """Load the content blocks that were not loaded yet."""
+
+        preloaded = get_preloaded_content_blocks(context)
+        slugs = []
+        for slug in self.slugs:
+            slug = slug.resolve(context, True)
+            if slug and slug not in preloaded and slug not in slugs:
+                slugs.append(slug)
+
+        if slugs:
+            preloaded.update(caching.get_many_permitted_for_current_site(
+                models.ContentBlock,
+                slugs
+            ))
+
+        return ''
@@ -7,22 +7,34 @@ Defines custom queryset objects
 import random
 
 from django.conf import settings
-from django.contrib.sites.models import Site
 from django.db.models.query import QuerySet
-from django.contrib.contenttypes.models import ContentType
 
 # from polymorphic import PolymorphicQuerySet
 
-from tunobase.core import constants
+from tunobase.core import constants, content_types, sites
+
+
+# The site filter keyword of each model class
+_site_filter_keys = {}
+
+
+def get_site_filter_key(model):
+    '''
+    Return the keyword used to filter the given model by site
+    '''
+    try:
+        return _site_filter_keys[model]
+    except KeyError:
+        key = 'sites__id__exact' if hasattr(model, 'sites') else 'site_id'
+        _site_filter_keys[model] = key
+        return key
 
 
 class CoreQuerySet(QuerySet):
 
     def for_current_site(self):
-        key = '%s__id__exact' % 'sites' if hasattr(self.model, 'sites') \
-                else 'site_id'
         params = {
-            key: Site.objects.get_current().id
+            get_site_filter_key(self.model): sites.get_current_site().id
         }
         return self.filter(**params)
 
@@ -35,52 +47,43 @@ class CoreStateQuerySet(CoreQuerySet):
         constants.STATE_PUBLISHED
 
     def get_list(self):
-        from tunobase.core.models import Version
-        model_type = ContentType.objects.get_for_model(self.model)
-        model_qs = Version.objects.filter(
-            content_type__pk=model_type.id,
-            state=self.STATE
+        from tunobase.core.models import LiveVersion
+        return self.filter_pointed_to(LiveVersion).exclude(
+            state=constants.STATE_DELETED
         )
-        model_pks = model_qs.values_list('object_id', flat=True)
-        model_series = model_qs.values_list('series_id', flat=True)
-        next_model_qs = Version.objects.filter(
-            content_type__pk=model_type.id,
-            state=self.NEXT_STATE
-        ).exclude(series_id__in=model_series)
-        next_model_pks = next_model_qs.values_list('object_id', flat=True)
-        next_model_series = next_model_qs.values_list('series_id', flat=True)
-        bottom_model_qs = Version.objects.filter(
-            content_type__pk=model_type.id,
-            state=self.BOTTOM_STATE
-        ).exclude(series_id__in=list(model_series) + list(next_model_series))
-        series_ids = {}
-        bottom_model_pks = []
-        for bottom_model in bottom_model_qs:
-            if bottom_model.series_id not in series_ids:
-                series_ids[bottom_model.series_id] = None
-                bottom_model_pks.append(bottom_model.object_id)
-        return self.filter(
-            pk__in=list(model_pks) + list(next_model_pks) + list(bottom_model_pks)
-        ).exclude(state=constants.STATE_DELETED)
 
-    def get_console_queryset(self):
+    def filter_pointed_to(self, pointer_model, **pointer_filters):
+        '''
+        Restrict the queryset to objects referenced by a row of
+        ``pointer_model`` (a model with ``content_type`` and ``object_id``
+        columns, such as Version or LiveVersion) matching the given
+        column filters.
+
+        The check is a subquery that the database resolves with the
+        content type and object id index of the pointer model, rather
+        than a list of object ids read beforehand. Being built with the
+        ORM, it is re-aliased when the queryset is nested in another query.
+        '''
+        return self.filter(pk__in=pointer_model.objects.filter(
+            content_type_id=content_types.get_id_for_model(self.model),
+            **pointer_filters
+        ).values('object_id'))
+
+    def filter_versioned(self, **version_filters):
+        '''
+        Restrict the queryset to objects that have a Version matching
+        the given column filters.
+        '''
         from tunobase.core.models import Version
-        model_type = ContentType.objects.get_for_model(self.model)
-        model_pks = Version.objects.filter(
-            content_type__pk=model_type.id,
-        ).values_list('object_id', flat=True)
-        return self.filter(pk__in=model_pks).exclude(
+        return self.filter_pointed_to(Version, **version_filters)
+
+    def get_console_queryset(self):
+        return self.filter_versioned().exclude(
             state=constants.STATE_DELETED
         )
 
     def permitted(self):
-        from tunobase.core.models import Version
-        model_type = ContentType.objects.get_for_model(self.model)
-        model_pks = Version.objects.filter(
-            content_type__pk=model_type.id,
-            state=self.SITE_STATE
-        ).values_list('object_id', flat=True)
-        return self.filter(pk__in=model_pks).exclude(
+        return self.filter_versioned(state=self.SITE_STATE).exclude(
             state=constants.STATE_DELETED
         )
 
@@ -0,0 +1,82 @@
+'''
+CORE APP
+
+Current site resolution shared by querysets, tagging and the mailer.
+
+The site of the current request is kept in a thread local by
+CurrentSiteMiddleware. Outside of a request the site configured by
+SITE_ID is used, which Django already caches per process. Sites looked
+up by request host are cached per process as well, in a cache bound by
+SITE_HOST_CACHE_SIZE since the host header is chosen by the client.
+
+'''
+import threading
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.db.models.signals import post_save, post_delete
+
+from tunobase.core.utils import LRUCache
+
+_current = threading.local()
+
+sites_by_host = LRUCache(getattr(settings, 'SITE_HOST_CACHE_SIZE', 256))
+
+
+def get_current_site():
+    '''
+    Return the site of the current request, or the SITE_ID site
+    '''
+    site = getattr(_current, 'site', None)
+    if site is None:
+        site = Site.objects.get_current()
+    return site
+
+
+def set_current_site(site):
+    '''
+    Make site the current site of this thread
+    '''
+    _current.site = site
+
+
+def clear_current_site():
+    '''
+    Fall back to the SITE_ID site in this thread
+    '''
+    _current.site = None
+
+
+def get_site_for_host(host):
+    '''
+    Return the site whose domain matches the given host, ignoring any
+    port, or the SITE_ID site if there is no such site
+    '''
+    host = host.split(':')[0].lower()
+    site = sites_by_host.get(host)
+    if site is None:
+        try:
+            site = Site.objects.get(domain__iexact=host)
+        except Site.DoesNotExist:
+            site = Site.objects.get_current()
+        sites_by_host.set(host, site)
+    return site
+
+
+def clear_site_cache(**kwargs):
+    '''
+    Forget the sites looked up by host. Connected to Site changes.
+    '''
+    sites_by_host.clear()
+
+
+post_save.connect(
+    clear_site_cache,
+    sender=Site,
+    dispatch_uid='tunobase.core.sites'
+)
+post_delete.connect(
+    clear_site_cache,
+    sender=Site,
+    dispatch_uid='tunobase.core.sites'
+)
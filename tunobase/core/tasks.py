@@ -4,11 +4,38 @@ CORE APP
 Celery tasks
 
 '''
+import logging
+
 from celery.decorators import task
 
+from django.core.cache import cache
+
 from tunobase.core import models
 
+logger = logging.getLogger('console')
+
 
 @task(ignore_result=True)
 def publish_objects():
-    models.Version.objects.publish_objects()
+    results = models.Version.objects.publish_objects()
+    for label, result in sorted(results.items()):
+        logger.info(
+            'Published %(versions)s versions and %(objects)s objects '
+            'of %(label)s in %(seconds).3fs' % dict(result, label=label)
+        )
+
+
+@task(ignore_result=True)
+def apply_scheduled_transitions(wakeup=None):
+    manager = models.ScheduledTransition.objects
+    applied = manager.apply_due()
+    if applied:
+        logger.info('Applied %s scheduled transitions' % applied)
+
+    # Sleep until the next transition is due, leaving the wake up time
+    # of any other run in place
+    if wakeup is not None and cache.get(manager.wakeup_cache_key) == wakeup:
+        cache.delete(manager.wakeup_cache_key)
+    next_due = manager.next_due()
+    if next_due is not None:
+        manager.wake_up_at(next_due)
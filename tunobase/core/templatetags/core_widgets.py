@@ -6,12 +6,46 @@ Created on 31 Oct 2013
 from copy import copy
 
 from django import template
+from django.conf import settings
+from django.core.cache import cache
 from django.template.defaulttags import url
+from django.template.loader import get_template
 
-from tunobase.core import models, nodes
+from tunobase.core import caching, models, nodes
 
 register = template.Library()
 
+
+def _get_content_block(context, slug):
+    preloaded = nodes.get_preloaded_content_blocks(context)
+    if slug not in preloaded:
+        preloaded[slug] = caching.get_permitted_for_current_site(
+            models.ContentBlock,
+            slug
+        )
+    return preloaded[slug]
+
+
+def _render_widget(template_name, context, obj, member_model):
+    '''
+    Render a set widget, caching the fragment when
+    WIDGET_FRAGMENT_CACHE_TIMEOUT is set. Fragments are keyed on the set,
+    site, staging mode and language, and on the generations of the set
+    and member models so that any change to either invalidates them.
+    '''
+    timeout = getattr(settings, 'WIDGET_FRAGMENT_CACHE_TIMEOUT', None)
+    if obj is None or timeout is None:
+        return get_template(template_name).render(context)
+
+    key = caching.get_fragment_cache_key(template_name, obj, member_model)
+    fragment = cache.get(key)
+    if fragment is None:
+        fragment = get_template(template_name).render(context)
+        cache.set(key, fragment, timeout)
+
+    return fragment
+
+
 @register.inclusion_tag('core/inclusion_tags/pagination_widget.html', takes_context=True)
 def pagination_widget(context, page_obj):
     context = copy(context)
@@ -41,13 +75,30 @@ def ajax_more_pagination_widget(context, page_obj, pagination_url):
     })
     return context
 
+@register.tag
+def preload_content_blocks(parser, token):
+    '''
+    Resolves content blocks with a single query ahead of the
+    content_block_widget and content_block_plain tags that use them.
+    Without arguments every content block tag that follows in the
+    same template is preloaded.
+
+    Examples:
+        {% preload_content_blocks %}
+        {% preload_content_blocks "header" "footer" slug_var %}
+    '''
+    bits = token.split_contents()[1:]
+    if not bits:
+        bits = nodes.find_content_block_slugs(parser.tokens)
+
+    return nodes.PreloadContentBlocksNode(
+        [parser.compile_filter(bit) for bit in bits]
+    )
+
 @register.inclusion_tag('core/inclusion_tags/content_block_widget.html', takes_context=True)
 def content_block_widget(context, slug):
     context = copy(context)
-    try:
-        content = models.ContentBlock.objects.permitted().for_current_site().get(slug=slug)
-    except models.ContentBlock.DoesNotExist:
-        content = None
+    content = _get_content_block(context, slug)
 
     context.update({
         'content': content,
@@ -59,10 +110,7 @@ def content_block_widget(context, slug):
 @register.inclusion_tag('core/inclusion_tags/content_block_plain.html', takes_context=True)
 def content_block_plain(context, slug):
     context = copy(context)
-    try:
-        content = models.ContentBlock.objects.permitted().for_current_site().get(slug=slug)
-    except models.ContentBlock.DoesNotExist:
-        content = None
+    content = _get_content_block(context, slug)
 
     context.update({
         'content': content,
@@ -71,53 +119,65 @@ def content_block_plain(context, slug):
 
     return context
 
-@register.inclusion_tag('core/inclusion_tags/gallery_widget.html', takes_context=True)
+@register.simple_tag(takes_context=True)
 def gallery_widget(context, slug):
     context = copy(context)
-    try:
-        gallery = models.Gallery.objects.permitted()\
-            .for_current_site().get(slug=slug)
-    except models.Gallery.DoesNotExist:
-        gallery = None
+    gallery = caching.get_permitted_for_current_site(
+        models.Gallery,
+        slug
+    )
     
     context.update({
         'gallery': gallery,
         'slug': slug
     })
     
-    return context
+    return _render_widget(
+        'core/inclusion_tags/gallery_widget.html',
+        context,
+        gallery,
+        models.GalleryImage
+    )
     
-@register.inclusion_tag('core/inclusion_tags/image_bannerset_widget.html', takes_context=True)
+@register.simple_tag(takes_context=True)
 def image_bannerset_widget(context, slug):
     context = copy(context)
-    try:
-        bannerset = models.ImageBannerSet.objects.permitted()\
-            .for_current_site().get(slug=slug)
-    except models.ImageBannerSet.DoesNotExist:
-        bannerset = None
+    bannerset = caching.get_permitted_for_current_site(
+        models.ImageBannerSet,
+        slug
+    )
     
     context.update({
         'bannerset': bannerset,
         'slug': slug
     })
     
-    return context
-
-@register.inclusion_tag('core/inclusion_tags/html_bannerset_widget.html', takes_context=True)
+    return _render_widget(
+        'core/inclusion_tags/image_bannerset_widget.html',
+        context,
+        bannerset,
+        models.ImageBanner
+    )
+
+@register.simple_tag(takes_context=True)
 def html_bannerset_widget(context, slug):
     context = copy(context)
-    try:
-        bannerset = models.HTMLBannerSet.objects.permitted()\
-            .for_current_site().get(slug=slug)
-    except models.HTMLBannerSet.DoesNotExist:
-        bannerset = None
+    bannerset = caching.get_permitted_for_current_site(
+        models.HTMLBannerSet,
+        slug
+    )
     
     context.update({
         'bannerset': bannerset,
         'slug': slug
     })
     
-    return context
+    return _render_widget(
+        'core/inclusion_tags/html_bannerset_widget.html',
+        context,
+        bannerset,
+        models.HTMLBanner
+    )
     
 @register.tag
 def breadcrumb_widget(parser, token):
@@ -4,11 +4,29 @@ CORE APP
 Tests for the core app.
 
 '''
+import json
+from datetime import timedelta
+from unittest import skipIf
+
+from django.contrib.auth.models import Group, Permission, User
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.core import serializers
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Count
+from django.template import Context, Template
 from django.template.defaultfilters import slugify
-from django.test import TestCase
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils import timezone
 
-from tunobase.core import constants, models
+from tunobase.core import caching, constants, content_types, models, sites, \
+        utils
+from tunobase.core.middleware import CurrentSiteMiddleware
+from tunobase.serializers import compact, compact_json, compact_msgpack, \
+        json as json_serializer, python as python_serializer, \
+        register_serializers
 
 class ContentModelTestCase(TestCase):
     title = 'Content Model Test Case Title'
@@ -61,3 +79,940 @@ class ContentModelTestCase(TestCase):
 
         self.assertLessEqual(audit_object.created_at, timezone.now())
         self.assertLessEqual(audit_object.modified_at, timezone.now())
+
+
+class VersionedQuerySetTestCase(TestCase):
+    title = 'Versioned Query Set Test Case Title'
+    slug = slugify(title)
+
+    def setUp(self):
+        '''
+        Create a Content Model with a single Version in the Database
+        '''
+        content_object = models.ContentModel.objects.create(title=self.title)
+        models.ContentModel.objects.add_version(content_object)
+
+    def test_permitted(self):
+        '''
+        Test that only objects with a Version in the site state are permitted
+        '''
+        self.assertTrue(
+            models.ContentModel.objects.permitted()\
+                    .filter(slug=self.slug).exists()
+        )
+
+        content_object = models.ContentModel.objects.get(slug=self.slug)
+        models.ContentModel.objects.unpublish_version(content_object.pk)
+        self.assertFalse(
+            models.ContentModel.objects.permitted()\
+                    .filter(slug=self.slug).exists()
+        )
+
+        models.ContentModel.objects.create(title='Unversioned Title')
+        self.assertFalse(
+            models.ContentModel.objects.permitted()\
+                    .filter(slug=slugify('Unversioned Title')).exists()
+        )
+
+    def test_nested(self):
+        '''
+        Test that the versioned querysets can be nested in another query
+        '''
+        for queryset in (
+                models.ContentModel.objects.permitted(),
+                models.ContentModel.objects.get_console_queryset(),
+                models.ContentModel.objects.get_list()):
+            self.assertEqual(
+                list(models.ContentModel.objects.filter(
+                    pk__in=queryset.values('pk')
+                ).values_list('slug', flat=True)),
+                [self.slug]
+            )
+
+        content_block = models.ContentBlock.objects.create(
+            title='Content Block Title',
+            alternative_title='Content Block Title'
+        )
+        models.ContentBlock.objects.add_version(content_block)
+        self.assertEqual(
+            list(models.ContentModel.objects.filter(
+                pk__in=models.ContentBlock.objects.permitted().values('pk')
+            )),
+            [content_block.contentmodel_ptr]
+        )
+
+    def test_console_queryset(self):
+        '''
+        Test that the console queryset contains versioned objects only
+        '''
+        models.ContentModel.objects.create(title='Unversioned Title')
+        self.assertEqual(
+            list(models.ContentModel.objects.get_console_queryset()\
+                    .values_list('slug', flat=True)),
+            [self.slug]
+        )
+
+    def test_get_list(self):
+        '''
+        Test that get_list follows the displayed version of each series
+        '''
+        content_object = models.ContentModel.objects.get(slug=self.slug)
+        series = models.ContentModel.objects.get_series(content_object.pk)
+        new_object = models.ContentModel.objects.create(
+            title='New Version Title',
+            state=constants.STATE_UNPUBLISHED
+        )
+        models.ContentModel.objects.add_to_series(series, new_object)
+
+        self.assertEqual(
+            list(models.ContentModel.objects.get_list()),
+            [content_object]
+        )
+
+        models.ContentModel.objects.publish_version(new_object.pk)
+        self.assertEqual(
+            list(models.ContentModel.objects.get_list()),
+            [new_object]
+        )
+        self.assertEqual(
+            models.LiveVersion.objects.check_consistency(), []
+        )
+
+    def test_publish_objects(self):
+        '''
+        Test that due versions without a published sibling get published
+        '''
+        content_object = models.ContentModel.objects.get(slug=self.slug)
+        models.ContentModel.objects.unpublish_version(content_object.pk)
+
+        results = models.Version.objects.publish_objects()
+
+        self.assertEqual(results['core.ContentModel']['versions'], 1)
+        self.assertEqual(
+            models.ContentModel.objects.get(slug=self.slug).state,
+            constants.STATE_PUBLISHED
+        )
+        self.assertTrue(
+            models.ContentModel.objects.permitted()\
+                    .filter(slug=self.slug).exists()
+        )
+        self.assertEqual(
+            models.LiveVersion.objects.check_consistency(), []
+        )
+
+    def test_publish_objects_queries(self):
+        '''
+        Test that the number of queries does not grow with the number of
+        series published
+        '''
+        query_counts = []
+        for count in (1, 5):
+            for i in range(count):
+                content_object = models.ContentModel.objects.create(
+                    title='%s %s %s' % (self.title, count, i)
+                )
+                models.ContentModel.objects.add_version(content_object)
+                models.ContentModel.objects.unpublish_version(
+                    content_object.pk
+                )
+
+            with CaptureQueriesContext(connection) as queries:
+                results = models.Version.objects.publish_objects()
+            self.assertEqual(results['core.ContentModel']['versions'], count)
+            query_counts.append(len(queries))
+
+        self.assertEqual(query_counts[0], query_counts[1])
+        self.assertEqual(
+            models.LiveVersion.objects.check_consistency(), []
+        )
+
+
+class ScheduledTransitionTestCase(TestCase):
+    title = 'Scheduled Transition Test Case Title'
+    slug = slugify(title)
+
+    def test_schedule(self):
+        '''
+        Test that future publish and retract times are scheduled and applied
+        '''
+        now = timezone.now()
+        content_object = models.ContentModel.objects.create(
+            title=self.title,
+            state=constants.STATE_UNPUBLISHED,
+            publish_at=now + timedelta(hours=1),
+            retract_at=now + timedelta(hours=2)
+        )
+        self.assertEqual(
+            list(models.ScheduledTransition.objects.values_list(
+                'action', flat=True)),
+            [constants.TRANSITION_PUBLISH, constants.TRANSITION_RETRACT]
+        )
+        self.assertEqual(
+            models.ScheduledTransition.objects.next_due(),
+            content_object.publish_at
+        )
+
+        applied = models.ScheduledTransition.objects.apply_due(
+            now + timedelta(hours=1)
+        )
+        self.assertEqual(applied, 1)
+        self.assertEqual(
+            models.ContentModel.objects.get(slug=self.slug).state,
+            constants.STATE_PUBLISHED
+        )
+
+        models.ScheduledTransition.objects.apply_due(
+            now + timedelta(hours=2)
+        )
+        self.assertEqual(
+            models.ContentModel.objects.get(slug=self.slug).state,
+            constants.STATE_UNPUBLISHED
+        )
+        self.assertIsNone(models.ScheduledTransition.objects.next_due())
+
+    def test_publish_objects_after_retract(self):
+        '''
+        Test that publish_objects does not publish retracted objects again
+        '''
+        now = timezone.now()
+        content_object = models.ContentModel.objects.create(
+            title=self.title,
+            state=constants.STATE_UNPUBLISHED,
+            publish_at=now - timedelta(hours=2),
+            retract_at=now - timedelta(hours=1)
+        )
+        models.ContentModel.objects.add_version(content_object)
+
+        models.ContentModel.objects.publish_objects()
+        models.Version.objects.publish_objects()
+        self.assertEqual(
+            models.ContentModel.objects.get(slug=self.slug).state,
+            constants.STATE_UNPUBLISHED
+        )
+
+    def test_save_without_schedule_change(self):
+        '''
+        Test that saving an object only reschedules it when its schedule
+        changes
+        '''
+        now = timezone.now()
+        content_object = models.ContentModel.objects.create(
+            title=self.title,
+            state=constants.STATE_UNPUBLISHED,
+            publish_at=now + timedelta(hours=1)
+        )
+        content_object = models.ContentModel.objects.get(pk=content_object.pk)
+        content_object.plain_content = 'Changed content'
+        with CaptureQueriesContext(connection) as queries:
+            content_object.save()
+        self.assertFalse([
+            query for query in queries.captured_queries
+            if 'scheduledtransition' in query['sql']
+        ])
+
+        content_object.publish_at = now + timedelta(hours=3)
+        content_object.save()
+        self.assertEqual(
+            models.ScheduledTransition.objects.get().due_at,
+            content_object.publish_at
+        )
+        self.assertEqual(
+            models.ScheduledTransition.objects.next_due(),
+            content_object.publish_at
+        )
+
+
+class StringTemplateCacheTestCase(TestCase):
+
+    def test_render_string_to_string(self):
+        '''
+        Test that a template string is compiled once and rendered with
+        each context
+        '''
+        utils.string_template_cache.clear()
+        string = 'Hello {{ name }}'
+
+        self.assertEqual(
+            utils.render_string_to_string(string, {'name': 'A'}), 'Hello A'
+        )
+        self.assertEqual(
+            utils.render_string_to_string(string, {'name': 'B'}), 'Hello B'
+        )
+        stats = utils.string_template_cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_lru_cache(self):
+        '''
+        Test that the least recently used entry is discarded
+        '''
+        cache = utils.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(len(cache), 2)
+
+
+class ContentTypeCacheTestCase(TestCase):
+
+    def setUp(self):
+        content_types.invalidate()
+
+    def test_cache_hit(self):
+        '''
+        Test that lookups after the map is loaded need no queries
+        '''
+        content_type = ContentType.objects.get_for_model(ContentType)
+        content_types.warm()
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                content_types.get_id_for_model(ContentType),
+                content_type.pk
+            )
+            self.assertEqual(
+                content_types.get_id_by_natural_key(
+                    'contenttypes', 'contenttype'
+                ),
+                content_type.pk
+            )
+
+    def test_miss(self):
+        '''
+        Test that a content type created after the map was loaded is
+        resolved once and then served from the map
+        '''
+        content_types.warm()
+        # Created without signals, as by another process
+        ContentType.objects.bulk_create([ContentType(
+            app_label='tunobase_tests',
+            model='missing',
+            name='missing'
+        )])
+        content_type = ContentType.objects.get_by_natural_key(
+            'tunobase_tests', 'missing'
+        )
+        misses = content_types.get_miss_count()
+
+        for i in range(2):
+            self.assertEqual(
+                content_types.get_id_by_natural_key(
+                    'tunobase_tests', 'missing'
+                ),
+                content_type.pk
+            )
+        self.assertEqual(content_types.get_miss_count(), misses + 1)
+
+    def test_invalidation(self):
+        '''
+        Test that changing a content type drops the map
+        '''
+        content_types.warm()
+        content_type = ContentType.objects.create(
+            app_label='tunobase_tests',
+            model='changed',
+            name='changed'
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                content_types.get_id_by_natural_key(
+                    'tunobase_tests', 'changed'
+                ),
+                content_type.pk
+            )
+
+
+class ContentCacheTestCase(TestCase):
+    title = 'Content Cache Test Case Title'
+    slug = slugify(title)
+
+    def setUp(self):
+        '''
+        Create a permitted Content Block on the current site
+        '''
+        cache.clear()
+        self.content_block = models.ContentBlock.objects.create(
+            title=self.title,
+            alternative_title=self.title
+        )
+        self.content_block.sites.add(Site.objects.get_current())
+        models.ContentBlock.objects.add_version(self.content_block)
+
+    def test_cache_hit(self):
+        '''
+        Test that a cached object is returned without a query
+        '''
+        caching.get_permitted_for_current_site(models.ContentBlock, self.slug)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                caching.get_permitted_for_current_site(
+                    models.ContentBlock, self.slug
+                ),
+                self.content_block
+            )
+
+    def test_missing(self):
+        '''
+        Test that a missing object is cached too
+        '''
+        self.assertIsNone(caching.get_permitted_for_current_site(
+            models.ContentBlock, 'missing'
+        ))
+        with self.assertNumQueries(0):
+            self.assertIsNone(caching.get_permitted_for_current_site(
+                models.ContentBlock, 'missing'
+            ))
+
+    def test_invalidation(self):
+        '''
+        Test that saving an object invalidates the cached object
+        '''
+        caching.get_permitted_for_current_site(models.ContentBlock, self.slug)
+        self.content_block.alternative_title = 'Changed Title'
+        self.content_block.save()
+
+        self.assertEqual(
+            caching.get_permitted_for_current_site(
+                models.ContentBlock, self.slug
+            ).alternative_title,
+            'Changed Title'
+        )
+
+        models.ContentBlock.objects.unpublish_version(self.content_block.pk)
+        self.assertIsNone(caching.get_permitted_for_current_site(
+            models.ContentBlock, self.slug
+        ))
+
+    def test_get_many(self):
+        '''
+        Test that uncached objects are resolved with a single query and
+        then served from the cache
+        '''
+        expected = {self.slug: self.content_block, 'missing': None}
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                caching.get_many_permitted_for_current_site(
+                    models.ContentBlock, [self.slug, 'missing']
+                ),
+                expected
+            )
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                caching.get_many_permitted_for_current_site(
+                    models.ContentBlock, [self.slug, 'missing']
+                ),
+                expected
+            )
+
+
+class PreloadContentBlocksTestCase(TestCase):
+
+    def setUp(self):
+        '''
+        Create two permitted Content Blocks on the current site
+        '''
+        cache.clear()
+        site = Site.objects.get_current()
+        for title in ('Header', 'Footer'):
+            content_block = models.ContentBlock.objects.create(
+                title=title,
+                alternative_title=title,
+                plain_content='%s content' % title
+            )
+            content_block.sites.add(site)
+            models.ContentBlock.objects.add_version(content_block)
+
+    def render(self, template_string):
+        return Template(
+            '{% load core_widgets %}' + template_string
+        ).render(Context())
+
+    def test_preload_queries(self):
+        '''
+        Test that the content blocks of a template are resolved with a
+        single query, including the missing ones
+        '''
+        with self.assertNumQueries(1):
+            output = self.render(
+                '{% preload_content_blocks %}'
+                '{% content_block_plain "header" %}'
+                '{% content_block_plain "footer" %}'
+                '{% content_block_widget "missing" %}'
+            )
+        self.assertIn('Header content', output)
+        self.assertIn('Footer content', output)
+
+    def test_preload_arguments(self):
+        '''
+        Test that only the given content blocks are preloaded
+        '''
+        with self.assertNumQueries(2):
+            output = self.render(
+                '{% preload_content_blocks "header" %}'
+                '{% content_block_plain "header" %}'
+                '{% content_block_plain "footer" %}'
+            )
+        self.assertIn('Header content', output)
+        self.assertIn('Footer content', output)
+
+
+@override_settings(WIDGET_FRAGMENT_CACHE_TIMEOUT=60)
+class WidgetFragmentCacheTestCase(TestCase):
+
+    def setUp(self):
+        '''
+        Create a permitted HTML Banner Set with one Banner on the
+        current site
+        '''
+        cache.clear()
+        site = Site.objects.get_current()
+        self.banner = models.HTMLBanner.objects.create(
+            title='Banner',
+            rich_content='Banner content'
+        )
+        self.banner.sites.add(site)
+        models.HTMLBanner.objects.add_version(self.banner)
+
+        bannerset = models.HTMLBannerSet.objects.create(slug='slider')
+        bannerset.sites.add(site)
+        bannerset.banners.add(self.banner)
+        models.HTMLBannerSet.objects.add_version(bannerset)
+
+    def render(self):
+        return Template(
+            '{% load core_widgets %}{% html_bannerset_widget "slider" %}'
+        ).render(Context())
+
+    def test_cache_hit(self):
+        '''
+        Test that a cached fragment is rendered without queries
+        '''
+        output = self.render()
+        self.assertIn('Banner content', output)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.render(), output)
+
+    def test_invalidation(self):
+        '''
+        Test that changing a member invalidates the fragment
+        '''
+        self.render()
+        self.banner.rich_content = 'Changed content'
+        self.banner.save()
+
+        self.assertIn('Changed content', self.render())
+
+    @override_settings(WIDGET_FRAGMENT_CACHE_TIMEOUT=None)
+    def test_disabled(self):
+        '''
+        Test that fragments are not cached by default
+        '''
+        self.render()
+        with self.assertNumQueries(1):
+            self.render()
+
+
+class CurrentSiteTestCase(TestCase):
+
+    def setUp(self):
+        sites.clear_current_site()
+        sites.clear_site_cache()
+        self.site = Site.objects.create(
+            domain='other.example.com',
+            name='Other'
+        )
+
+    def tearDown(self):
+        sites.clear_current_site()
+
+    def test_middleware(self):
+        '''
+        Test that the current site is shared for the request only
+        '''
+        request = RequestFactory().get('/')
+        middleware = CurrentSiteMiddleware()
+        middleware.process_request(request)
+
+        self.assertEqual(request.site, Site.objects.get_current())
+        with self.assertNumQueries(0):
+            self.assertEqual(sites.get_current_site(), request.site)
+
+        sites.set_current_site(self.site)
+        self.assertEqual(sites.get_current_site(), self.site)
+        middleware.process_response(request, None)
+        self.assertEqual(sites.get_current_site(), Site.objects.get_current())
+
+    @override_settings(SITE_FROM_REQUEST_HOST=True)
+    def test_site_for_host(self):
+        '''
+        Test that the site of the request host is looked up once
+        '''
+        request = RequestFactory().get(
+            '/', HTTP_HOST='Other.example.com:8000'
+        )
+        CurrentSiteMiddleware().process_request(request)
+        self.assertEqual(request.site, self.site)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                sites.get_site_for_host('other.example.com'), self.site
+            )
+
+    def test_unknown_host(self):
+        '''
+        Test that an unknown host falls back to the SITE_ID site and is
+        cached too
+        '''
+        self.assertEqual(
+            sites.get_site_for_host('unknown.example.com'),
+            Site.objects.get_current()
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                sites.get_site_for_host('unknown.example.com'),
+                Site.objects.get_current()
+            )
+
+    def test_bounded(self):
+        '''
+        Test that the sites looked up by host are bounded by
+        SITE_HOST_CACHE_SIZE
+        '''
+        for i in range(sites.sites_by_host.size + 10):
+            sites.get_site_for_host('host%s.example.com' % i)
+        self.assertEqual(len(sites.sites_by_host), sites.sites_by_host.size)
+
+    def test_invalidation(self):
+        '''
+        Test that changing a site clears the sites looked up by host
+        '''
+        sites.get_site_for_host('renamed.example.com')
+        self.site.domain = 'renamed.example.com'
+        self.site.save()
+
+        self.assertEqual(
+            sites.get_site_for_host('renamed.example.com'), self.site
+        )
+
+
+class StreamingSerializerTestCase(TestCase):
+
+    def setUp(self):
+        '''
+        Create Groups with Permissions to prefetch
+        '''
+        permissions = list(Permission.objects.order_by('pk')[:10])
+        for i in range(5):
+            group = Group.objects.create(name='Group %s' % i)
+            group.permissions = permissions[i * 2:i * 2 + 2]
+
+    def serialize(self, queryset, **options):
+        return json.loads(json_serializer.Serializer().serialize(
+            queryset,
+            relations=['permissions'],
+            fields_only=True,
+            **options
+        ))
+
+    def test_streaming(self):
+        '''
+        Test that a queryset with prefetched relations is streamed a chunk
+        at a time, paged by primary key
+        '''
+        expected = self.serialize(Group.objects.all())
+        with CaptureQueriesContext(connection) as queries:
+            streamed = self.serialize(
+                Group.objects.all(), streaming=True, chunk_size=2
+            )
+
+        self.assertEqual(streamed, expected)
+        self.assertEqual(len(queries), 6)
+        self.assertFalse([
+            query for query in queries.captured_queries
+            if 'OFFSET' in query['sql'].upper()
+        ])
+
+        self.assertEqual(
+            self.serialize(
+                Group.objects.order_by('-pk'), streaming=True, chunk_size=2
+            ),
+            expected[::-1]
+        )
+
+    def test_tied_ordering(self):
+        '''
+        Test that objects that sort equally are streamed once each when
+        paged with OFFSET
+        '''
+        queryset = Group.objects.annotate(
+            permission_count=Count('permissions')
+        ).order_by('-permission_count')
+        with CaptureQueriesContext(connection) as queries:
+            streamed = self.serialize(queryset, streaming=True, chunk_size=2)
+
+        self.assertEqual(
+            [obj['name'] for obj in streamed],
+            list(Group.objects.order_by('pk').values_list('name', flat=True))
+        )
+        self.assertTrue([
+            query for query in queries.captured_queries
+            if 'OFFSET' in query['sql'].upper()
+        ])
+
+    def test_sliced(self):
+        '''
+        Test that a sliced queryset is streamed whole
+        '''
+        queryset = Group.objects.order_by('pk')[1:4]
+        self.assertEqual(
+            self.serialize(queryset, streaming=True, chunk_size=2),
+            self.serialize(queryset)
+        )
+
+
+class SerializerTestCase(TestCase):
+
+    def setUp(self):
+        '''
+        Create Sites to serialize
+        '''
+        self.sites = [
+            Site.objects.create(domain='site%s.com' % i, name='Site %s' % i)
+            for i in range(3)
+        ]
+
+    def serialize(self, queryset, **options):
+        return python_serializer.Serializer().serialize(queryset, **options)
+
+    def test_field_plan(self):
+        '''
+        Test that the fields of a model are planned once and serialized
+        as listed in fields and excludes
+        '''
+        site = self.sites[0]
+        expected = [{
+            'model': u'sites.site',
+            'pk': site.pk,
+            'fields': {'domain': u'site0.com'},
+        }]
+        queryset = Site.objects.filter(pk=site.pk)
+        self.assertEqual(self.serialize(queryset, fields=['domain']), expected)
+        self.assertEqual(self.serialize(queryset, excludes=['name']), expected)
+        self.assertEqual(
+            self.serialize(site, fields=['domain'])[0]['fields'],
+            {'domain': u'site0.com'}
+        )
+
+        serializer = python_serializer.Serializer()
+        serializer.serialize(Site.objects.all())
+        self.assertEqual(serializer._plans.keys(), [Site])
+
+    def test_select_related(self):
+        '''
+        Test that related objects serialized along with a queryset are
+        selected with it
+        '''
+        permissions = list(Permission.objects.order_by('pk')[:3])
+        with self.assertNumQueries(1):
+            data = self.serialize(
+                Permission.objects.filter(
+                    pk__in=[permission.pk for permission in permissions]
+                ).order_by('pk'),
+                fields=['codename', 'content_type'],
+                relations={'content_type': {
+                    'fields': ['model'],
+                    'fields_only': True,
+                }},
+                fields_only=True
+            )
+
+        self.assertEqual(data, [
+            {
+                'codename': permission.codename,
+                'content_type': {'model': permission.content_type.model},
+            }
+            for permission in permissions
+        ])
+
+    def test_prefetch_related(self):
+        '''
+        Test that many to many relations and the relations below them are
+        prefetched, whatever the number of objects
+        '''
+        permissions = list(Permission.objects.all()[:4])
+        options = {
+            'fields': ['name', 'permissions'],
+            'relations': {'permissions': {
+                'fields': ['codename', 'content_type'],
+                'relations': {'content_type': {
+                    'fields': ['model'],
+                    'fields_only': True,
+                }},
+                'fields_only': True,
+            }},
+            'fields_only': True,
+        }
+
+        for count in (1, 2):
+            group = Group.objects.create(name='Group %s' % count)
+            group.permissions = permissions[count * 2 - 2:count * 2]
+            with self.assertNumQueries(3):
+                data = self.serialize(
+                    Group.objects.order_by('pk'), **dict(options)
+                )
+
+        self.assertEqual(data, [
+            {
+                'name': u'Group %s' % count,
+                'permissions': [
+                    {
+                        'codename': permission.codename,
+                        'content_type': {
+                            'model': permission.content_type.model
+                        },
+                    }
+                    for permission in permissions[count * 2 - 2:count * 2]
+                ],
+            }
+            for count in (1, 2)
+        ])
+
+    def test_shared_related(self):
+        '''
+        Test that each relation is serialized by one serializer that
+        serializes an object once, remembers a bounded number of them and
+        hands out copies
+        '''
+        options = {
+            'fields': ['codename', 'content_type'],
+            'relations': {'content_type': {
+                'fields': ['model'],
+                'fields_only': True,
+            }},
+            'fields_only': True,
+        }
+        permissions = list(Permission.objects.select_related('content_type'))
+        expected = [
+            {
+                'codename': permission.codename,
+                'content_type': {'model': permission.content_type.model},
+            }
+            for permission in permissions
+        ]
+
+        serializer = python_serializer.Serializer()
+        data = serializer.serialize(Permission.objects.all(), **dict(options))
+        self.assertEqual(data, expected)
+        self.assertEqual(serializer._children.keys(), ['content_type'])
+        self.assertEqual(
+            len(serializer._children['content_type']._serialized),
+            len(set(permission.content_type_id for permission in permissions))
+        )
+        self.assertIsNot(data[0]['content_type'], data[1]['content_type'])
+        data[0]['content_type']['model'] = 'changed'
+        self.assertEqual(data[1]['content_type'], expected[1]['content_type'])
+
+        related_cache_size = python_serializer.Serializer.related_cache_size
+        python_serializer.Serializer.related_cache_size = 2
+        try:
+            serializer = python_serializer.Serializer()
+            data = serializer.serialize(
+                Permission.objects.all(), **dict(options)
+            )
+        finally:
+            python_serializer.Serializer.related_cache_size = \
+                related_cache_size
+        self.assertEqual(data, expected)
+        self.assertEqual(
+            len(serializer._children['content_type']._serialized), 2
+        )
+
+    def test_values_fast_path(self):
+        '''
+        Test that querysets serialized from their values give the same
+        output as their model instances
+        '''
+        User.objects.create_user('user', 'user@example.com', 'password')
+        Group.objects.create(name='Group')
+
+        for queryset, options in (
+                (Site.objects.order_by('pk'), {}),
+                (Permission.objects.all(), {}),
+                (Permission.objects.all(), {'excludes': ['content_type']}),
+                (User.objects.all(), {'fields': ['username', 'last_login']}),
+                (User.objects.all(),
+                    {'excludes': ['groups', 'user_permissions']}),
+                (Group.objects.all(), {'excludes': ['permissions']})):
+            serializer = python_serializer.Serializer()
+            data = serializer.serialize(
+                queryset, fields_only=True, **dict(options)
+            )
+            self.assertIsNotNone(serializer._columns)
+            self.assertEqual(
+                data,
+                self.serialize(
+                    list(queryset), fields_only=True, **dict(options)
+                )
+            )
+
+        with self.assertNumQueries(1):
+            self.serialize(Permission.objects.all(), fields_only=True)
+
+    def get_mixed_objects(self):
+        group = Group.objects.create(name='Group')
+        group.permissions = Permission.objects.all()[:2]
+        return list(Site.objects.order_by('pk')) + [group, self.sites[0]]
+
+    def test_compact_json_round_trip(self):
+        '''
+        Test that objects of several models are written under a header
+        row per model and read back as the same objects
+        '''
+        objects = self.get_mixed_objects()
+        data = compact_json.Serializer().serialize(objects)
+
+        rows = json.loads(data)
+        self.assertEqual(
+            [row['model'] for row in rows if isinstance(row, dict)],
+            [u'sites.site', u'auth.group', u'sites.site']
+        )
+        self.assertEqual(
+            list(compact.get_objects(rows)), self.serialize(objects)
+        )
+        self.assertEqual(
+            [obj.object for obj in compact_json.Deserializer(data)],
+            objects
+        )
+
+    @skipIf(compact_msgpack.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_round_trip(self):
+        '''
+        Test that objects written as MessagePack are read back as the same
+        objects
+        '''
+        objects = self.get_mixed_objects()
+        data = compact_msgpack.Serializer().serialize(objects)
+
+        self.assertEqual(
+            [obj.object for obj in compact_msgpack.Deserializer(data)],
+            objects
+        )
+
+    def test_registered_formats(self):
+        '''
+        Test that the registered formats are found by Django
+        '''
+        register_serializers()
+        objects = self.get_mixed_objects()
+
+        formats = ['tunobase_json', 'compact_json']
+        if compact_msgpack.msgpack is not None:
+            formats.append('msgpack')
+        for format in formats:
+            data = serializers.serialize(format, objects)
+            self.assertEqual(
+                [obj.object for obj in serializers.deserialize(format, data)],
+                objects
+            )
@@ -4,8 +4,11 @@ CORE APP
 Core utilities.
 
 '''
+import hashlib
 import json
+import threading
 import types
+from collections import OrderedDict
 
 from django import http
 from django.template import Context, Template
@@ -109,11 +112,79 @@ def create_crumb(title, url=None):
     return crumb
 
 
+class LRUCache(object):
+    '''
+    A thread safe, size bound mapping that discards the least recently
+    used entry when it is full, and counts its hits and misses
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self):
+        return {
+            'size': self.size,
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+string_template_cache = LRUCache(
+    getattr(settings, 'STRING_TEMPLATE_CACHE_SIZE', 256)
+)
+
+
+def get_string_template(string):
+    '''
+    Return the compiled Template of a template string, compiling each
+    distinct string once per process
+    '''
+    key = hashlib.sha1(smart_unicode(string).encode('utf-8')).hexdigest()
+    template = string_template_cache.get(key)
+    if template is None:
+        template = Template(string)
+        string_template_cache.set(key, template)
+
+    return template
+
+
 def render_string_to_string(string, context):
     '''
     Renders a string with context
     '''
-    template = Template(string)
+    template = get_string_template(string)
     context = Context(context)
     return template.render(context)
 
@@ -24,14 +24,24 @@ class OutboundEmailAdmin(admin.ModelAdmin):
 
     list_display = (
             'user', 'to_addresses', 'bcc_addresses', 'sent_timestamp',
-            'subject', 'site'
-    )
-    list_filter = (
-            'user', 'to_addresses', 'bcc_addresses', 'sent_timestamp',
-            'subject', 'site'
-    )
-    search_fields = (
-            'user__email', 'to_addresses', 'bcc_addresses', 'subject', 'site'
+            'subject', 'site', 'status', 'attempts'
     )
+    list_filter = ('sent_timestamp', 'site', 'status')
+    search_fields = ('subject', '=user__email')
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Also return the emails sent to the searched address. Addresses
+        are stored lowercased, so they are matched exactly on their index.
+        """
+        results, use_distinct = super(OutboundEmailAdmin, self)\
+            .get_search_results(request, queryset, search_term)
+
+        address = search_term.strip().lower()
+        if address:
+            results |= queryset.filter(recipients__address=address)
+            use_distinct = True
+
+        return results, use_distinct
 
 admin.site.register(models.OutboundEmail, OutboundEmailAdmin)
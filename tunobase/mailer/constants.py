@@ -0,0 +1,25 @@
+"""
+MAILER APP
+
+This module provides the mailer app's constants.
+
+"""
+STATUS_PENDING = 0
+STATUS_SENDING = 1
+STATUS_SENT = 2
+STATUS_FAILED = 3
+
+STATUS_CHOICES = (
+    (STATUS_PENDING, 'Pending'),
+    (STATUS_SENDING, 'Sending'),
+    (STATUS_SENT, 'Sent'),
+    (STATUS_FAILED, 'Failed'),
+)
+
+RECIPIENT_TO = 0
+RECIPIENT_BCC = 1
+
+RECIPIENT_KIND_CHOICES = (
+    (RECIPIENT_TO, 'To'),
+    (RECIPIENT_BCC, 'Bcc'),
+)
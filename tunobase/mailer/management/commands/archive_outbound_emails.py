@@ -0,0 +1,108 @@
+"""
+MAILER APP
+
+Archive old outbound emails to compressed JSON Lines files.
+
+"""
+import gzip
+import json
+import os
+from datetime import timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from tunobase.mailer import constants, models
+
+FIELDS = (
+    'id', 'user_id', 'to_addresses', 'bcc_addresses', 'subject', 'message',
+    'body__content', 'sent_timestamp', 'site_id', 'from_address',
+    'text_content', 'status', 'attempts', 'last_error'
+)
+
+
+class Command(BaseCommand):
+    """
+    Stream the outbound emails of every bucket (month) that ended more
+    than --days days ago to one gzipped JSON Lines file per bucket, then
+    delete them along with the message bodies no email uses any more.
+    Emails are deleted batch by batch once written, so an interrupted run
+    can be resumed; a resumed run appends to the bucket's file.
+    """
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--days',
+            type='int',
+            default=getattr(settings, 'OUTBOUND_EMAIL_RETENTION_DAYS', 365),
+            help='Keep emails sent within this many days.'
+        ),
+        make_option(
+            '--directory',
+            default=getattr(settings, 'OUTBOUND_EMAIL_ARCHIVE_DIR', '.'),
+            help='Directory to write the archive files to.'
+        ),
+        make_option(
+            '--batch-size',
+            type='int',
+            default=1000,
+            help='Number of emails to read and delete at a time.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        cutoff = models.get_bucket(
+            timezone.now() - timedelta(days=options['days'])
+        )
+        emails = models.OutboundEmail.objects.filter(
+            bucket__lt=cutoff,
+            status__in=(constants.STATUS_SENT, constants.STATUS_FAILED)
+        )
+        buckets = emails.order_by('bucket')\
+            .values_list('bucket', flat=True).distinct()
+
+        for bucket in list(buckets):
+            path = os.path.join(
+                options['directory'], 'outbound_emails-%s.jsonl.gz' % bucket
+            )
+            count = self.archive_bucket(
+                emails.filter(bucket=bucket), path, options['batch_size']
+            )
+            print 'Archived %s emails to %s' % (count, path)
+
+        deleted = models.MessageBody.objects.delete_orphans(
+            options['batch_size']
+        )
+        print 'Deleted %s unused message bodies' % deleted
+
+    def archive_bucket(self, emails, path, batch_size):
+        count = 0
+        last_pk = 0
+        archive = gzip.open(path, 'ab')
+        try:
+            while True:
+                rows = list(
+                    emails.filter(pk__gt=last_pk).order_by('pk')\
+                        .values(*FIELDS)[:batch_size]
+                )
+                if not rows:
+                    break
+
+                for row in rows:
+                    row['message'] = row.pop('body__content') or row['message']
+                    row['sent_timestamp'] = row['sent_timestamp'].isoformat()
+                    archive.write(json.dumps(row) + '\n')
+                archive.flush()
+
+                last_pk = rows[-1]['id']
+                with transaction.atomic():
+                    models.OutboundEmail.objects.filter(
+                        pk__in=[row['id'] for row in rows]
+                    ).delete()
+                count += len(rows)
+        finally:
+            archive.close()
+
+        return count
@@ -0,0 +1,53 @@
+"""
+MAILER APP
+
+Index the recipients of emails tracked before recipients were indexed.
+
+"""
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from tunobase.mailer import models
+
+
+class Command(BaseCommand):
+    """
+    Create the recipient rows of the emails that have none.
+    """
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--batch-size',
+            type='int',
+            default=1000,
+            help='Number of emails to index at a time.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        manager = models.OutboundEmail.objects
+        emails = manager.filter(recipients__isnull=True).only(
+            'to_addresses', 'bcc_addresses'
+        )
+
+        count = 0
+        last_pk = 0
+        while True:
+            batch = list(
+                emails.filter(pk__gt=last_pk).order_by('pk')\
+                    [:options['batch_size']]
+            )
+            if not batch:
+                break
+
+            recipients = []
+            for outbound_email in batch:
+                recipients.extend(manager.get_recipients(outbound_email))
+            with transaction.atomic():
+                models.OutboundEmailRecipient.objects.bulk_create(recipients)
+
+            last_pk = batch[-1].pk
+            count += len(batch)
+
+        print 'Indexed the recipients of %s emails' % count
@@ -0,0 +1,283 @@
+"""
+MAILER APP
+
+Benchmark the throughput of the mailer.
+
+"""
+import asyncore
+import os
+import resource
+import smtpd
+import sys
+import threading
+import time
+import traceback
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.backends import util
+from django.test.utils import override_settings
+
+from tunobase.mailer import signals, utils as mailer_utils
+
+SUBJECT = 'Benchmark message for {{ name }}'
+TEXT_CONTENT = 'Hello {{ name }},\n\n' + 'Benchmark text content. ' * 40
+HTML_CONTENT = '<p>Hello {{ name }},</p>' + '<p>Benchmark content.</p>' * 40
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+
+class Rollback(Exception):
+    """Raised to roll back the rows written by a benchmark."""
+
+
+class CountingCursor(util.CursorWrapper):
+    """A cursor that reports the statements it runs to a WriteCounter."""
+
+    def __init__(self, cursor, db, counter):
+        super(CountingCursor, self).__init__(cursor, db)
+        self.counter = counter
+
+    def execute(self, sql, params=None):
+        self.counter.count(sql)
+        return super(CountingCursor, self).execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.counter.count(sql)
+        return super(CountingCursor, self).executemany(sql, param_list)
+
+
+class WriteCounter(object):
+    """
+    Counts the write statements run on a connection. Unlike
+    CaptureQueriesContext it keeps no SQL, so it does not add to the
+    memory being measured.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.writes = 0
+
+    def __enter__(self):
+        self.use_debug_cursor = self.connection.use_debug_cursor
+        self.connection.use_debug_cursor = True
+        self.connection.make_debug_cursor = self.make_cursor
+        return self
+
+    def __exit__(self, *args):
+        del self.connection.make_debug_cursor
+        self.connection.use_debug_cursor = self.use_debug_cursor
+
+    def make_cursor(self, cursor):
+        return CountingCursor(cursor, self.connection, self)
+
+    def count(self, sql):
+        if sql.lstrip().upper().startswith(WRITE_STATEMENTS):
+            self.writes += 1
+
+
+class SinkServer(smtpd.SMTPServer):
+    """An SMTP server that counts and discards the messages it receives."""
+
+    received = 0
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received += 1
+
+
+class SMTPSink(object):
+    """Runs a SinkServer on a free local port in a background thread."""
+
+    def __enter__(self):
+        self.server = SinkServer(('127.0.0.1', 0), None)
+        self.port = self.server.socket.getsockname()[1]
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def serve(self):
+        while self.running:
+            asyncore.loop(timeout=0.1, count=1)
+
+    def __exit__(self, *args):
+        self.running = False
+        self.thread.join()
+        self.server.close()
+
+
+class Command(BaseCommand):
+    """
+    Send mail through send_mail, send_mass_mail and the tracking path
+    alone to a local SMTP sink and to Django's locmem backend, and report
+    messages per second, render time, database writes per message and
+    peak memory for each number of recipients. Every run is rolled back.
+
+    Each run is forked into a process of its own, so that its peak memory
+    is the growth of the peak resident memory of that process alone.
+    """
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--sizes',
+            default='1,1000,100000',
+            help='Comma separated numbers of recipients to benchmark.'
+        ),
+        make_option(
+            '--backends',
+            default='smtp,locmem',
+            help='Comma separated backends to benchmark: smtp, locmem.'
+        ),
+        make_option(
+            '--paths',
+            default='send_mail,send_mass_mail,track',
+            help='Comma separated paths to benchmark.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes must be a list of numbers')
+        backends = options['backends'].split(',')
+        paths = options['paths'].split(',')
+        for path in paths:
+            if not hasattr(self, 'run_%s' % path):
+                raise CommandError('Unknown path: %s' % path)
+
+        self.render_time = 0
+        signals.message_rendered.connect(self.record_render_time)
+        try:
+            print '%-15s %-7s %8s %10s %10s %12s %10s' % (
+                'path', 'backend', 'messages', 'msgs/sec', 'render ms',
+                'writes/msg', 'peak MB'
+            )
+            for backend in backends:
+                for path in paths:
+                    for size in sizes:
+                        self.benchmark(backend, path, size)
+        finally:
+            signals.message_rendered.disconnect(self.record_render_time)
+
+    def record_render_time(self, sender, render_time, **kwargs):
+        self.render_time += render_time
+
+    def benchmark(self, backend, path, size):
+        if backend == 'smtp':
+            with SMTPSink() as sink:
+                self.run(backend, path, size, {
+                    'EMAIL_BACKEND':
+                        'django.core.mail.backends.smtp.EmailBackend',
+                    'EMAIL_HOST': '127.0.0.1',
+                    'EMAIL_PORT': sink.port,
+                    'EMAIL_HOST_USER': '',
+                    'EMAIL_HOST_PASSWORD': '',
+                    'EMAIL_USE_TLS': False,
+                })
+        elif backend == 'locmem':
+            self.run(backend, path, size, {
+                'EMAIL_BACKEND':
+                    'django.core.mail.backends.locmem.EmailBackend',
+            })
+        else:
+            raise CommandError('Unknown backend: %s' % backend)
+
+    def run(self, backend, path, size, email_settings):
+        # Neither process may share the database connection of the other
+        connection.close()
+        sys.stdout.flush()
+
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self.measure(backend, path, size, email_settings)
+                status = 0
+            except Exception:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+
+        if os.waitpid(pid, 0)[1]:
+            raise CommandError('Benchmark of %s failed' % path)
+
+    def measure(self, backend, path, size, email_settings):
+        email_settings.update({
+            'EMAIL_ENABLED': True,
+            'EMAIL_QUEUED': False,
+            'EMAIL_EXTRA_BCC_LIST': [],
+        })
+        self.render_time = 0
+        # A forked process starts with its current memory as its peak
+        started_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        with override_settings(**email_settings):
+            try:
+                with transaction.atomic():
+                    with WriteCounter(connection) as counter:
+                        started = time.time()
+                        getattr(self, 'run_%s' % path)(size)
+                        seconds = time.time() - started
+                    raise Rollback
+            except Rollback:
+                pass
+
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print '%-15s %-7s %8s %10.1f %10.1f %12.2f %10.1f' % (
+            path,
+            backend,
+            size,
+            size / seconds if seconds else 0,
+            self.render_time * 1000,
+            float(counter.writes) / size,
+            (peak_rss - started_rss) / 1024.0
+        )
+
+    def get_recipients(self, size):
+        for i in xrange(size):
+            yield (
+                ['recipient%s@example.com' % i],
+                {'name': 'Recipient %s' % i}
+            )
+
+    def run_send_mail(self, size):
+        environment = mailer_utils.MailEnvironment()
+        for to_addresses, context in self.get_recipients(size):
+            mailer_utils.send_mail(
+                SUBJECT,
+                TEXT_CONTENT,
+                to_addresses,
+                html_content=HTML_CONTENT,
+                context=context,
+                apply_context_to_string=True,
+                environment=environment
+            )
+
+    def run_send_mass_mail(self, size):
+        mailer_utils.send_mass_mail(
+            SUBJECT,
+            TEXT_CONTENT,
+            self.get_recipients(size),
+            html_content=HTML_CONTENT,
+            apply_context_to_string=True
+        )
+
+    def run_track(self, size):
+        environment = mailer_utils.MailEnvironment()
+        outbound_emails = []
+        for to_addresses, context in self.get_recipients(size):
+            outbound_emails.append(mailer_utils.create_outbound_email(
+                SUBJECT,
+                to_addresses,
+                HTML_CONTENT.replace('{{ name }}', context['name']),
+                site=environment.site
+            ))
+            if len(outbound_emails) >= 100:
+                mailer_utils.save_outbound_emails(outbound_emails)
+                outbound_emails = []
+        if outbound_emails:
+            mailer_utils.save_outbound_emails(outbound_emails)
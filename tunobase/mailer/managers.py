@@ -0,0 +1,267 @@
+"""
+MAILER APP
+
+This module provides the managers of the mailer models.
+
+Classes:
+    MessageBodyManager
+    OutboundEmailManager
+
+Functions:
+    n/a
+
+"""
+import hashlib
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
+from django.utils.encoding import smart_unicode
+
+from tunobase.mailer import constants
+
+
+class MessageBodyManager(models.Manager):
+    """Store each distinct message body once."""
+
+    def get_hash(self, content):
+        """Return the hash a message body is stored under."""
+
+        return hashlib.sha1(smart_unicode(content).encode('utf-8')).hexdigest()
+
+    def get_for_content(self, content):
+        """Return the stored message body with the given content."""
+
+        content_hash = self.get_hash(content)
+        try:
+            return self.get(hash=content_hash)
+        except self.model.DoesNotExist:
+            try:
+                with transaction.atomic():
+                    return self.create(hash=content_hash, content=content)
+            except IntegrityError:
+                return self.get(hash=content_hash)
+
+    def get_for_contents(self, contents):
+        """
+        Return a dictionary mapping the hash of each of the given contents
+        to its stored message body, storing the new ones with a single
+        insert. Call it in the transaction that saves the emails using the
+        bodies: the stored bodies are locked until it commits so that
+        delete_orphans cannot delete them in the meantime.
+        """
+        contents = dict(
+            (self.get_hash(content), content) for content in contents
+        )
+        if not contents:
+            return {}
+
+        bodies = self._lock(contents.keys())
+        new_bodies = [
+            self.model(hash=content_hash, content=content)
+            for content_hash, content in contents.items()
+            if content_hash not in bodies
+        ]
+        if new_bodies:
+            try:
+                with transaction.atomic():
+                    self.bulk_create(new_bodies)
+            except IntegrityError:
+                # Some were stored concurrently, store the others one by one
+                for body in new_bodies:
+                    self.get_for_content(body.content)
+            bodies = self._lock(contents.keys())
+
+        return bodies
+
+    def _lock(self, hashes):
+        return dict(
+            (body.hash, body) for body in self.select_for_update()\
+                .filter(hash__in=hashes).order_by('pk')
+        )
+
+    def delete_orphans(self, batch_size=1000):
+        """
+        Delete the message bodies no email refers to any more and return
+        the number deleted. Each batch of orphans is locked, which waits
+        for the emails being saved with them, and checked again before it
+        is deleted.
+        """
+        deleted = 0
+        last_pk = 0
+        while True:
+            pks = list(self.filter(
+                pk__gt=last_pk,
+                outbound_emails__isnull=True
+            ).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+
+            with transaction.atomic():
+                list(self.select_for_update().filter(pk__in=pks)\
+                    .values_list('pk', flat=True))
+                orphans = list(self.filter(
+                    pk__in=pks,
+                    outbound_emails__isnull=True
+                ).values_list('pk', flat=True))
+                self.filter(pk__in=orphans).delete()
+            deleted += len(orphans)
+            last_pk = pks[-1]
+
+        return deleted
+
+
+class OutboundEmailManager(models.Manager):
+    """Store and look up emails by their recipients."""
+
+    # Cache key holding the time the queue worker is due to wake up
+    wakeup_cache_key = 'tunobase.mailer.queue.wakeup'
+
+    def get_recipients(self, outbound_email):
+        """Return the unsaved recipients of an email."""
+
+        from tunobase.mailer import models as mailer_models
+
+        recipients = []
+        for kind, addresses in (
+                (constants.RECIPIENT_TO, outbound_email.to_addresses),
+                (constants.RECIPIENT_BCC, outbound_email.bcc_addresses)):
+            for address in set((addresses or '').split('\n')):
+                address = address.strip().lower()
+                if address:
+                    recipients.append(mailer_models.OutboundEmailRecipient(
+                        email_id=outbound_email.pk,
+                        address=address,
+                        kind=kind
+                    ))
+
+        return recipients
+
+    def resolve_bodies(self, outbound_emails):
+        """
+        Replace the unsaved message bodies of the emails with the stored
+        bodies with the same content.
+        """
+        from tunobase.mailer import models as mailer_models
+
+        unresolved = [
+            outbound_email for outbound_email in outbound_emails
+            if outbound_email.body_id is None \
+                and outbound_email.body is not None
+        ]
+        if not unresolved:
+            return
+
+        manager = mailer_models.MessageBody.objects
+        bodies = manager.get_for_contents(set(
+            outbound_email.body.content for outbound_email in unresolved
+        ))
+        for outbound_email in unresolved:
+            outbound_email.body = bodies[
+                manager.get_hash(outbound_email.body.content)
+            ]
+
+    def save_with_recipients(self, outbound_emails):
+        """
+        Save the emails in one transaction, resolving their message bodies
+        together and writing the new emails and the recipients of all of
+        them with a bulk insert each. Bulk inserts do not return ids, so
+        each new email is given a unique batch_key to look its id up by.
+        The recipients of emails that were saved before are rewritten.
+        """
+        from tunobase.mailer import models as mailer_models
+
+        with transaction.atomic():
+            self.resolve_bodies(outbound_emails)
+
+            new_emails = []
+            saved_pks = []
+            for outbound_email in outbound_emails:
+                if outbound_email.pk is not None:
+                    outbound_email.save()
+                    saved_pks.append(outbound_email.pk)
+                    continue
+                if outbound_email.bucket is None:
+                    outbound_email.bucket = mailer_models.get_bucket(
+                        timezone.now()
+                    )
+                outbound_email.batch_key = uuid.uuid4().hex
+                new_emails.append(outbound_email)
+
+            if new_emails:
+                self.bulk_create(new_emails)
+                by_batch_key = dict(
+                    (outbound_email.batch_key, outbound_email)
+                    for outbound_email in new_emails
+                )
+                for batch_key, pk in self.filter(
+                        batch_key__in=by_batch_key.keys()
+                        ).values_list('batch_key', 'pk'):
+                    outbound_email = by_batch_key[batch_key]
+                    outbound_email.pk = pk
+                    outbound_email._state.adding = False
+                    outbound_email._state.db = self.db
+
+            if saved_pks:
+                mailer_models.OutboundEmailRecipient.objects.filter(
+                    email_id__in=saved_pks
+                ).delete()
+            recipients = []
+            for outbound_email in outbound_emails:
+                recipients.extend(self.get_recipients(outbound_email))
+            mailer_models.OutboundEmailRecipient.objects\
+                .bulk_create(recipients)
+
+    def next_attempt_at(self):
+        """
+        Return the time the earliest queued email that is waiting for a
+        retry or for the lease of its worker to expire is due.
+        """
+        try:
+            return self.filter(
+                status__in=(
+                    constants.STATUS_PENDING,
+                    constants.STATUS_SENDING
+                ),
+                next_attempt_at__isnull=False
+            ).order_by('next_attempt_at').values_list(
+                'next_attempt_at', flat=True
+            )[0]
+        except IndexError:
+            return None
+
+    def wake_up_at(self, due_at):
+        """
+        Make sure the queue worker runs at due_at unless it is already due
+        to run earlier. A wake up time more than EMAIL_QUEUE_WAKEUP_GRACE
+        seconds in the past is treated as lost so that a dropped task
+        cannot stall the queue.
+        """
+        from tunobase.mailer import tasks
+
+        now = timezone.now()
+        # Eagerly executed tasks ignore their eta and cannot sleep
+        if getattr(settings, 'CELERY_ALWAYS_EAGER', False) and due_at > now:
+            return
+
+        lost_at = now - timedelta(
+            seconds=getattr(settings, 'EMAIL_QUEUE_WAKEUP_GRACE', 60)
+        )
+        wakeup = cache.get(self.wakeup_cache_key)
+        if wakeup is None or wakeup <= lost_at or due_at < wakeup:
+            cache.set(self.wakeup_cache_key, due_at, None)
+            tasks.send_queued_mail.apply_async((None, due_at), eta=due_at)
+
+    def sent_to(self, address, kind=None):
+        """
+        Return the emails sent to the given address, optionally only
+        those it was a To or Bcc recipient of.
+        """
+        filters = {'recipients__address': address.strip().lower()}
+        if kind is not None:
+            filters['recipients__kind'] = kind
+
+        return self.filter(**filters).distinct()
@@ -4,10 +4,12 @@ MAILER APP
 This module describes the data layout for the mailer app.
 
 Classes:
+    MessageBody
     OutboundEmail
+    OutboundEmailRecipient
 
 Functions:
-    n/a
+    get_bucket
 
 Created on 22 Oct 2013
 
@@ -17,12 +19,39 @@ Created on 22 Oct 2013
 from django.db import models
 from django.conf import settings
 from django.contrib.sites.models import Site
+from django.utils import timezone
 
 from redactor.fields import RedactorTextField
 
+from tunobase.mailer import constants, managers
+
+
+def get_bucket(timestamp):
+    """Return the YYYYMM bucket an email sent at timestamp is stored in."""
+
+    return timestamp.year * 100 + timestamp.month
+
+
+class MessageBody(models.Model):
+    """Stores each distinct rendered email body once."""
+
+    hash = models.CharField(max_length=40, unique=True)
+    content = models.TextField()
+
+    objects = managers.MessageBodyManager()
+
+    def __unicode__(self):
+        """Return the hash of the message body."""
+
+        return self.hash
+
 
 class OutboundEmail(models.Model):
-    """Tracks emails sent to Users by the system."""
+    """
+    Tracks emails sent to Users by the system and, when mail is queued,
+    holds the emails waiting to be sent.
+
+    """
 
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -33,9 +62,38 @@ class OutboundEmail(models.Model):
     to_addresses = models.TextField()
     bcc_addresses = models.TextField(blank=True, null=True)
     subject = models.CharField(max_length=250)
-    message = RedactorTextField()
+    message = RedactorTextField(blank=True, null=True)
+    body = models.ForeignKey(
+        MessageBody,
+        related_name='outbound_emails',
+        blank=True,
+        null=True
+    )
     sent_timestamp = models.DateTimeField(auto_now_add=True)
+    bucket = models.PositiveIntegerField(blank=True, null=True, db_index=True)
     site = models.ForeignKey(Site)
+    # Looks up the ids of emails saved with a bulk insert
+    batch_key = models.CharField(
+        max_length=32,
+        blank=True,
+        null=True,
+        db_index=True,
+        editable=False
+    )
+
+    # Delivery of queued emails
+    from_address = models.CharField(max_length=254, blank=True, null=True)
+    text_content = models.TextField(blank=True, null=True)
+    status = models.PositiveSmallIntegerField(
+        choices=constants.STATUS_CHOICES,
+        default=constants.STATUS_SENT,
+        db_index=True
+    )
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+    next_attempt_at = models.DateTimeField(blank=True, null=True)
+
+    objects = managers.OutboundEmailManager()
 
     class Meta:
         """Order by sent timestamp."""
@@ -46,3 +104,39 @@ class OutboundEmail(models.Model):
         """Return the timestamp and subject of the mailer."""
 
         return u'%s - %s' % (self.sent_timestamp, self.subject)
+
+    def save(self, *args, **kwargs):
+        """
+        Store the email in the bucket of the month it is sent in, along
+        with its message body if it is not stored yet.
+        """
+        if self.bucket is None:
+            self.bucket = get_bucket(timezone.now())
+        if self.body_id is None and self.body is not None:
+            self.body = MessageBody.objects.get_for_content(self.body.content)
+
+        super(OutboundEmail, self).save(*args, **kwargs)
+
+    @property
+    def html(self):
+        """Return the rendered HTML of the email."""
+
+        if self.body_id is not None:
+            return self.body.content
+
+        return self.message
+
+
+class OutboundEmailRecipient(models.Model):
+    """Indexes the To and Bcc recipients of emails by address."""
+
+    email = models.ForeignKey(OutboundEmail, related_name='recipients')
+    address = models.CharField(max_length=254, db_index=True)
+    kind = models.PositiveSmallIntegerField(
+        choices=constants.RECIPIENT_KIND_CHOICES
+    )
+
+    def __unicode__(self):
+        """Return the address of the recipient."""
+
+        return self.address
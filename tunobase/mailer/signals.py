@@ -0,0 +1,15 @@
+"""
+MAILER APP
+
+This module provides the mailer app's signals.
+
+Signals:
+    message_rendered
+
+"""
+from django.dispatch import Signal
+
+# Sent once the subject, text and html content of a message have been
+# rendered, with the time rendering took in seconds. Connect a metrics
+# backend to this signal to record mail rendering times.
+message_rendered = Signal(providing_args=['message', 'render_time'])
@@ -0,0 +1,55 @@
+"""
+MAILER APP
+
+Celery tasks
+
+Functions:
+    send_queued_mail
+
+send_queued_mail is queued whenever an email is queued and sleeps until
+the next retry is due. A worker may look for an email before the
+transaction that queued it commits, so also run it periodically to pick
+up such emails, for example every minute:
+
+    CELERYBEAT_SCHEDULE = {
+        'send-queued-mail': {
+            'task': 'tunobase.mailer.tasks.send_queued_mail',
+            'schedule': timedelta(minutes=1),
+        },
+    }
+
+"""
+import logging
+
+from celery.decorators import task
+
+from django.core.cache import cache
+
+from tunobase.mailer import models, utils
+
+logger = logging.getLogger('console')
+
+
+@task(ignore_result=True)
+def send_queued_mail(batch_size=None, wakeup=None):
+    """
+    Send a batch of queued emails, queueing another run of the task
+    while there are more emails to send. Once no email is due the task
+    sleeps until the next retry or expired lease is due.
+    """
+    # Let emails queued from now on wake up another run, unless another
+    # wake up was scheduled meanwhile
+    manager = models.OutboundEmail.objects
+    if wakeup is not None and cache.get(manager.wakeup_cache_key) == wakeup:
+        cache.delete(manager.wakeup_cache_key)
+
+    sent, failed = utils.send_queued_mail(batch_size)
+    if sent or failed:
+        logger.info('Sent %s queued emails, %s failed' % (sent, failed))
+        send_queued_mail.delay(batch_size)
+        return
+
+    # Sleep until the next email is due
+    next_attempt_at = manager.next_attempt_at()
+    if next_attempt_at is not None:
+        manager.wake_up_at(next_attempt_at)
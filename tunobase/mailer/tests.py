@@ -0,0 +1,581 @@
+"""
+MAILER APP
+
+Tests for the mailer app.
+
+"""
+import base64
+import smtplib
+from datetime import timedelta
+from StringIO import StringIO
+
+from django.contrib import admin
+from django.contrib.sites.models import Site
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends.base import BaseEmailBackend
+from django.template.base import TemplateDoesNotExist
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from tunobase.core import utils as core_utils
+from tunobase.mailer import constants, models, signals, tasks, utils
+from tunobase.mailer.admin import OutboundEmailAdmin
+
+MAIL_SETTINGS = {
+    'EMAIL_BACKEND': 'django.core.mail.backends.locmem.EmailBackend',
+    'EMAIL_ENABLED': True,
+    'EMAIL_QUEUED': False,
+    'EMAIL_EXTRA_BCC_LIST': [],
+    'APP_NAME': 'Tunobase',
+    'CELERY_ALWAYS_EAGER': True,
+}
+
+
+class FailingBackend(BaseEmailBackend):
+    """An email backend that fails to send any message."""
+
+    def send_messages(self, email_messages):
+        raise smtplib.SMTPException('Failed to send')
+
+
+TEMPLATE_NAME = 'core/inclusion_tags/content_block_plain.html'
+
+
+def get_recipients(count):
+    return [
+        (['recipient%s@example.com' % i], {'name': 'Recipient %s' % i})
+        for i in range(count)
+    ]
+
+
+@override_settings(**MAIL_SETTINGS)
+class SendMassMailTestCase(TestCase):
+
+    def send(self, count, **kwargs):
+        return utils.send_mass_mail(
+            'Hello {{ name }}',
+            'Text for {{ name }}',
+            get_recipients(count),
+            html_content='<p>Html for {{ name }}</p>',
+            apply_context_to_string=True,
+            **kwargs
+        )
+
+    def test_send_mass_mail(self):
+        """
+        Test that each recipient gets a personalised message that is
+        tracked
+        """
+        self.assertEqual(self.send(5, chunk_size=2), 5)
+
+        self.assertEqual(
+            [message.subject for message in mail.outbox],
+            ['Hello Recipient %s' % i for i in range(5)]
+        )
+        self.assertEqual(
+            mail.outbox[0].alternatives,
+            [('<p>Html for Recipient 0</p>', 'text/html')]
+        )
+        outbound_email = models.OutboundEmail.objects.get(
+            to_addresses='recipient3@example.com'
+        )
+        self.assertEqual(outbound_email.subject, 'Hello Recipient 3')
+        self.assertEqual(outbound_email.html, '<p>Html for Recipient 3</p>')
+        self.assertEqual(models.OutboundEmail.objects.count(), 5)
+
+    def test_chunk_queries(self):
+        """
+        Test that the number of queries grows with the number of chunks,
+        not of messages
+        """
+        self.send(1)
+        query_counts = []
+        for count in (2, 10):
+            with CaptureQueriesContext(connection) as queries:
+                self.send(count, chunk_size=count)
+            query_counts.append(len(queries))
+
+        self.assertEqual(query_counts[0], query_counts[1])
+        self.assertEqual(models.OutboundEmail.objects.count(), 13)
+        self.assertEqual(
+            models.OutboundEmailRecipient.objects.count(), 13
+        )
+
+    def test_compiled_once(self):
+        """
+        Test that the content is compiled once per send and rendered once
+        per recipient
+        """
+        utils.resolved_templates.clear()
+        core_utils.string_template_cache.clear()
+        rendered = []
+
+        def receiver(sender, message, **kwargs):
+            rendered.append(message.subject)
+
+        signals.message_rendered.connect(receiver)
+        try:
+            self.send(5)
+        finally:
+            signals.message_rendered.disconnect(receiver)
+
+        self.assertEqual(
+            rendered, ['Hello Recipient %s' % i for i in range(5)]
+        )
+        for stats in (
+            utils.resolved_templates.get_stats(),
+            core_utils.string_template_cache.get_stats()
+        ):
+            self.assertEqual((stats['hits'], stats['misses']), (0, 3))
+
+    @override_settings(EMAIL_ENABLED=False)
+    def test_disabled(self):
+        """
+        Test that nothing is sent or tracked when email is disabled
+        """
+        self.send(2)
+
+        self.assertEqual(mail.outbox, [])
+        self.assertFalse(models.OutboundEmail.objects.exists())
+
+
+@override_settings(**MAIL_SETTINGS)
+class QueuedMailTestCase(TestCase):
+
+    def queue_email(self, count=1):
+        return [
+            models.OutboundEmail.objects.create(
+                to_addresses='recipient%s@example.com' % i,
+                subject='Queued %s' % i,
+                from_address='sender@example.com',
+                text_content='Text %s' % i,
+                status=constants.STATUS_PENDING,
+                site=Site.objects.get_current()
+            )
+            for i in range(count)
+        ]
+
+    def get_status(self, outbound_email):
+        return models.OutboundEmail.objects.get(pk=outbound_email.pk).status
+
+    def test_send_queued_mail(self):
+        """
+        Test that queued emails are sent a batch at a time
+        """
+        outbound_emails = self.queue_email(3)
+
+        self.assertEqual(utils.send_queued_mail(2), (2, 0))
+        self.assertEqual(
+            [message.subject for message in mail.outbox],
+            ['Queued 0', 'Queued 1']
+        )
+        self.assertEqual(
+            self.get_status(outbound_emails[2]), constants.STATUS_PENDING
+        )
+
+        self.assertEqual(utils.send_queued_mail(2), (1, 0))
+        self.assertEqual(utils.send_queued_mail(2), (0, 0))
+        self.assertEqual(
+            self.get_status(outbound_emails[2]), constants.STATUS_SENT
+        )
+
+    def test_retry(self):
+        """
+        Test that a failed email is retried once its backoff has passed
+        """
+        outbound_email, = self.queue_email()
+
+        with self.settings(
+                EMAIL_BACKEND='tunobase.mailer.tests.FailingBackend'):
+            self.assertEqual(utils.send_queued_mail(), (0, 1))
+        outbound_email = models.OutboundEmail.objects.get(
+            pk=outbound_email.pk
+        )
+        self.assertEqual(outbound_email.status, constants.STATUS_PENDING)
+        self.assertEqual(outbound_email.attempts, 1)
+        self.assertEqual(outbound_email.last_error, 'Failed to send')
+        self.assertGreater(outbound_email.next_attempt_at, timezone.now())
+        self.assertEqual(
+            models.OutboundEmail.objects.next_attempt_at(),
+            outbound_email.next_attempt_at
+        )
+
+        self.assertEqual(utils.send_queued_mail(), (0, 0))
+        models.OutboundEmail.objects.update(
+            next_attempt_at=timezone.now() - timedelta(seconds=1)
+        )
+        self.assertEqual(utils.send_queued_mail(), (1, 0))
+        self.assertEqual(
+            self.get_status(outbound_email), constants.STATUS_SENT
+        )
+        self.assertIsNone(models.OutboundEmail.objects.next_attempt_at())
+
+    @override_settings(
+        EMAIL_BACKEND='tunobase.mailer.tests.FailingBackend',
+        EMAIL_QUEUE_MAX_ATTEMPTS=1
+    )
+    def test_max_attempts(self):
+        """
+        Test that an email is given up on after its last attempt
+        """
+        outbound_email, = self.queue_email()
+
+        self.assertEqual(utils.send_queued_mail(), (0, 1))
+        self.assertEqual(
+            self.get_status(outbound_email), constants.STATUS_FAILED
+        )
+        self.assertIsNone(models.OutboundEmail.objects.next_attempt_at())
+
+    def test_lease(self):
+        """
+        Test that a claimed email is only claimed again once its lease
+        has expired
+        """
+        outbound_email, = self.queue_email()
+
+        self.assertEqual(len(utils._claim_queued_mail(10)), 1)
+        self.assertEqual(
+            self.get_status(outbound_email), constants.STATUS_SENDING
+        )
+        self.assertEqual(utils.send_queued_mail(), (0, 0))
+
+        models.OutboundEmail.objects.update(
+            next_attempt_at=timezone.now() - timedelta(seconds=1)
+        )
+        self.assertEqual(utils.send_queued_mail(), (1, 0))
+
+    def test_wake_up(self):
+        """
+        Test that queueing an email only wakes up a worker when none is
+        due to run, and that a run leaves other wake up times in place
+        """
+        manager = models.OutboundEmail.objects
+        message = mail.EmailMessage(
+            'Queued', 'Text', 'sender@example.com', ['recipient@example.com']
+        )
+        pending = manager.filter(status=constants.STATUS_PENDING)
+
+        wakeup = timezone.now() - timedelta(seconds=1)
+        cache.set(manager.wakeup_cache_key, wakeup, None)
+        utils.queue_message(message)
+        utils.queue_message(message)
+        self.assertEqual(pending.count(), 2)
+        self.assertEqual(mail.outbox, [])
+
+        tasks.send_queued_mail(wakeup=timezone.now())
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(cache.get(manager.wakeup_cache_key), wakeup)
+
+        cache.set(
+            manager.wakeup_cache_key,
+            timezone.now() - timedelta(minutes=5),
+            None
+        )
+        utils.queue_message(message)
+        self.assertFalse(pending.exists())
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertIsNone(cache.get(manager.wakeup_cache_key))
+
+
+@override_settings(**MAIL_SETTINGS)
+class TemplateResolutionTestCase(TestCase):
+
+    def setUp(self):
+        utils.resolved_templates.clear()
+
+    def test_literal(self):
+        """
+        Test that literal content is only looked up as a template once
+        """
+        for i in range(2):
+            self.assertIsNone(utils.resolve_template('Literal subject'))
+        stats = utils.resolved_templates.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+        self.assertEqual(
+            utils.render_content('Literal subject', 'Literal text'),
+            ('Literal subject', 'Literal text', None)
+        )
+
+    def test_template_name(self):
+        """
+        Test that content naming a template is rendered with the context
+        """
+        context = {'content': {'plain_content': 'Block content'}}
+
+        for content in (TEMPLATE_NAME, utils.TemplateName(TEMPLATE_NAME)):
+            subject, text_content, html_content = utils.render_content(
+                'Subject', content, context=context
+            )
+            self.assertEqual(text_content.strip(), 'Block content')
+
+        self.assertRaises(
+            TemplateDoesNotExist,
+            utils.compile_content,
+            utils.TemplateName('missing.html')
+        )
+
+    def test_template_string(self):
+        """
+        Test that content marked as a template string is never looked up
+        as a template name
+        """
+        self.assertIsNone(
+            utils.compile_content(utils.TemplateString(TEMPLATE_NAME))
+        )
+        self.assertEqual(utils.resolved_templates.get_stats()['misses'], 0)
+
+        self.assertEqual(
+            utils.render_content(
+                utils.TemplateString('Hello {{ name }}'),
+                'Text',
+                context={'name': 'Recipient'},
+                apply_context_to_string=True
+            )[0],
+            'Hello Recipient'
+        )
+
+
+@override_settings(**MAIL_SETTINGS)
+class MessageBodyTestCase(TestCase):
+
+    def test_shared_body(self):
+        """
+        Test that the html content of a chunk of emails is stored once,
+        without queries when the emails are created
+        """
+        site = Site.objects.get_current()
+        with self.assertNumQueries(0):
+            outbound_emails = [
+                utils.create_outbound_email(
+                    'Subject',
+                    ['recipient%s@example.com' % i],
+                    '<p>Html for %s</p>' % (i % 2),
+                    site=site
+                )
+                for i in range(4)
+            ]
+        models.OutboundEmail.objects.save_with_recipients(outbound_emails)
+
+        self.assertEqual(models.MessageBody.objects.count(), 2)
+        self.assertEqual(
+            [outbound_email.html for outbound_email in
+                models.OutboundEmail.objects.order_by('pk')],
+            ['<p>Html for 0</p>', '<p>Html for 1</p>'] * 2
+        )
+
+        utils.track_mail(
+            'Subject', ['recipient@example.com'], '<p>Html for 1</p>',
+            site=site
+        )
+        self.assertEqual(models.MessageBody.objects.count(), 2)
+
+    def test_delete_orphans(self):
+        """
+        Test that only the message bodies no email refers to are deleted
+        """
+        utils.track_mail(
+            'Subject', ['recipient@example.com'], '<p>Used</p>',
+            site=Site.objects.get_current()
+        )
+        models.MessageBody.objects.get_for_content('<p>Unused</p>')
+
+        self.assertEqual(models.MessageBody.objects.delete_orphans(), 1)
+        self.assertEqual(
+            list(models.MessageBody.objects.values_list(
+                'content', flat=True)),
+            ['<p>Used</p>']
+        )
+
+
+@override_settings(**MAIL_SETTINGS)
+class OutboundEmailRecipientTestCase(TestCase):
+
+    def setUp(self):
+        site = Site.objects.get_current()
+        self.outbound_emails = [
+            utils.create_outbound_email(
+                'Subject %s' % i,
+                ['Recipient%s@Example.com' % i],
+                '<p>Html</p>',
+                bcc_addresses=['bcc@example.com'],
+                site=site
+            )
+            for i in range(2)
+        ]
+        models.OutboundEmail.objects.save_with_recipients(
+            self.outbound_emails
+        )
+
+    def test_save_with_recipients(self):
+        """
+        Test that emails saved together get their ids and lowercased
+        recipients
+        """
+        for outbound_email in self.outbound_emails:
+            self.assertEqual(
+                models.OutboundEmail.objects.get(pk=outbound_email.pk)\
+                    .subject,
+                outbound_email.subject
+            )
+        self.assertEqual(
+            sorted(self.outbound_emails[0].recipients.values_list(
+                'address', 'kind')),
+            [
+                ('bcc@example.com', constants.RECIPIENT_BCC),
+                ('recipient0@example.com', constants.RECIPIENT_TO),
+            ]
+        )
+
+    def test_save_again(self):
+        """
+        Test that saving an email again rewrites its recipients
+        """
+        outbound_email = self.outbound_emails[0]
+        outbound_email.bcc_addresses = ''
+        models.OutboundEmail.objects.save_with_recipients([outbound_email])
+
+        self.assertEqual(
+            list(outbound_email.recipients.values_list('address', 'kind')),
+            [('recipient0@example.com', constants.RECIPIENT_TO)]
+        )
+        self.assertEqual(models.OutboundEmailRecipient.objects.count(), 3)
+
+    def test_sent_to(self):
+        """
+        Test that emails are looked up by any of their recipients
+        """
+        self.assertEqual(
+            list(models.OutboundEmail.objects.sent_to(
+                ' Recipient1@example.com')),
+            [self.outbound_emails[1]]
+        )
+        self.assertEqual(
+            models.OutboundEmail.objects.sent_to('bcc@example.com').count(),
+            2
+        )
+        self.assertFalse(models.OutboundEmail.objects.sent_to(
+            'bcc@example.com', constants.RECIPIENT_TO
+        ).exists())
+
+    def test_admin_search(self):
+        """
+        Test that the admin finds emails by exact recipient and by subject
+        """
+        model_admin = OutboundEmailAdmin(models.OutboundEmail, admin.site)
+        request = RequestFactory().get('/')
+        queryset = models.OutboundEmail.objects.all()
+
+        for search_term, expected in (
+                ('RECIPIENT0@example.com', [self.outbound_emails[0]]),
+                ('recipient0', []),
+                ('Subject 1', [self.outbound_emails[1]])):
+            results, use_distinct = model_admin.get_search_results(
+                request, queryset, search_term
+            )
+            self.assertEqual(list(results.distinct()), expected)
+
+
+@override_settings(**MAIL_SETTINGS)
+class AttachmentTestCase(TestCase):
+
+    def get_attachment(self):
+        attachment = StringIO('Attachment content ' * 1000)
+        attachment.name = '/tmp/report.txt'
+        return attachment
+
+    def test_prepare_attachment(self):
+        """
+        Test that an attachment encoded in chunks decodes to its content
+        """
+        part = utils.prepare_attachment(self.get_attachment(), 57 * 3)
+
+        self.assertEqual(part.get_content_type(), 'text/plain')
+        self.assertEqual(part.get_content_charset(), 'utf-8')
+        self.assertEqual(part.get_filename(), 'report.txt')
+        self.assertEqual(
+            base64.decodestring(part.get_payload()),
+            'Attachment content ' * 1000
+        )
+        self.assertIs(utils.prepare_attachment(part), part)
+
+    def test_send_mass_mail(self):
+        """
+        Test that an attachment is encoded once for every message
+        """
+        utils.send_mass_mail(
+            'Subject',
+            'Text',
+            get_recipients(2),
+            attachments=[self.get_attachment()]
+        )
+
+        parts = [message.attachments[0] for message in mail.outbox]
+        self.assertEqual(len(parts), 2)
+        self.assertIs(parts[0], parts[1])
+        self.assertEqual(parts[0].get_filename(), 'report.txt')
+
+
+@override_settings(**dict(
+    MAIL_SETTINGS, EMAIL_EXTRA_BCC_LIST=['extra@example.com']
+))
+class MailEnvironmentTestCase(TestCase):
+
+    def create_message(self, **kwargs):
+        attachment = StringIO('Attachment content')
+        attachment.name = '/tmp/report.txt'
+        return utils.create_message(
+            'Hello {{ name }}',
+            'Text for {{ name }}',
+            ['recipient@example.com'],
+            bcc_addresses=['bcc@example.com'],
+            html_content='<p>Html for {{ app_name }}</p>',
+            context={'name': 'Recipient'},
+            attachments=[attachment],
+            apply_context_to_string=True,
+            **kwargs
+        )
+
+    def get_headers(self, message):
+        mime_message = message.message()
+        return mime_message.get_content_type(), [
+            header for header in mime_message.items()
+            if header[0] not in ('Content-Type', 'Date', 'Message-ID')
+        ]
+
+    def test_create_message(self):
+        """
+        Test that a message built from a prepared environment matches one
+        built from the current site and settings
+        """
+        message, context = self.create_message()
+        environment = utils.MailEnvironment()
+        with self.assertNumQueries(0):
+            prepared_message, prepared_context = self.create_message(
+                environment=environment
+            )
+
+        self.assertEqual(message.subject, 'Hello Recipient')
+        self.assertEqual(message.body, 'Text for Recipient')
+        self.assertEqual(
+            message.bcc, ['bcc@example.com', 'extra@example.com']
+        )
+        self.assertEqual(context['site'], Site.objects.get_current())
+        self.assertEqual(context['app_name'], 'Tunobase')
+        self.assertEqual(prepared_context, context)
+
+        for attr in ('subject', 'body', 'from_email', 'to', 'bcc',
+                     'alternatives', 'extra_headers'):
+            self.assertEqual(
+                getattr(prepared_message, attr), getattr(message, attr)
+            )
+        self.assertEqual(
+            [part.as_string() for part in prepared_message.attachments],
+            [part.as_string() for part in message.attachments]
+        )
+        self.assertEqual(
+            self.get_headers(prepared_message), self.get_headers(message)
+        )
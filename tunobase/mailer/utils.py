@@ -5,35 +5,179 @@ This module provides utility functions for use with the
 mailer app.
 
 Classes:
-    n/a
+    TemplateName
+    TemplateString
+    MailEnvironment
 
 Functions:
     send_messages
+    resolve_template
+    prepare_attachment
     render_content
     create_message
+    get_html_content
     save_outbound_emails
     create_outbound_email
     send_mail
     track_mail
+    queue_message
+    send_queued_mail
+    compile_content
+    send_mass_mail
 
 Created on 22 Oct 2013
 
 @author: michael
 
 """
+import base64
+import hashlib
 import logging
+import mimetypes
+import os
+import time
+from datetime import timedelta
+from email.mime.base import MIMEBase
 
 from django.conf import settings
 from django.core.mail import get_connection, EmailMultiAlternatives
-from django.contrib.sites.models import Site
+from django.db import transaction
+from django.db.models import F, Q
+from django.template import Context
 from django.template.base import TemplateDoesNotExist
-from django.template.loader import render_to_string
+from django.template.loader import get_template
+from django.utils import timezone
+from django.utils.encoding import smart_unicode
 
-from tunobase.core import utils as core_utils
-from tunobase.mailer import models
+from tunobase.core import sites, utils as core_utils
+from tunobase.mailer import constants, models, signals
 
 logger = logging.getLogger('console')
 
+# Cached for content that is known not to be a template name
+LITERAL = 'tunobase.mailer.literal'
+# Cached for template names when their templates may change (DEBUG)
+TEMPLATE_NAME = 'tunobase.mailer.template_name'
+
+resolved_templates = core_utils.LRUCache(
+    getattr(settings, 'MAILER_RESOLVED_TEMPLATE_CACHE_SIZE', 1024)
+)
+
+class TemplateName(unicode):
+    """Marks mail content as the name of a template."""
+
+class TemplateString(unicode):
+    """Marks mail content as literal content, never a template name."""
+
+class MailEnvironment(object):
+    """
+    The site and settings every message is built with, gathered once so
+    that a batch of messages is built without touching the database or
+    the settings.
+    """
+
+    def __init__(self, site=None, from_address=None):
+        self.site = site if site is not None else sites.get_current_site()
+        self.from_address = from_address or settings.DEFAULT_FROM_EMAIL
+        self.static_url = settings.STATIC_URL
+        self.app_name = settings.APP_NAME
+        self.extra_bcc = list(getattr(settings, 'EMAIL_EXTRA_BCC_LIST', []))
+
+    def update_context(self, context, user=None):
+        """Add the site, user and settings to a message context."""
+
+        context.setdefault('site', self.site)
+        context.setdefault('user', user)
+        context['STATIC_URL'] = self.static_url
+        context['app_name'] = self.app_name
+
+        return context
+
+    def get_bcc_addresses(self, bcc_addresses=None):
+        """Return the BCC list with the extras from settings, if any."""
+
+        if bcc_addresses:
+            return bcc_addresses + self.extra_bcc
+
+        return list(self.extra_bcc)
+
+def resolve_template(content):
+    """
+    Return the template named by content, or None if content is not the
+    name of a template. Whether content names a template is remembered
+    per template loader configuration, so only the first lookup of each
+    literal subject or body probes the template loaders.
+    """
+    loaders_key = hashlib.sha1(repr((
+        settings.TEMPLATE_LOADERS,
+        settings.TEMPLATE_DIRS
+    ))).hexdigest()
+    key = '%s.%s' % (
+        loaders_key,
+        hashlib.sha1(smart_unicode(content).encode('utf-8')).hexdigest()
+    )
+
+    template = resolved_templates.get(key)
+    if template == LITERAL:
+        return None
+    if template is not None and template != TEMPLATE_NAME:
+        return template
+
+    try:
+        template = get_template(content)
+    except TemplateDoesNotExist:
+        resolved_templates.set(key, LITERAL)
+        return None
+
+    resolved_templates.set(key, TEMPLATE_NAME if settings.DEBUG else template)
+    return template
+
+def prepare_attachment(attachment, chunk_size=57 * 1024):
+    """
+    Return a base64 encoded MIME part for an attachment, a file object
+    or the path of a file, that can be attached to any number of
+    messages. The attachment is encoded once and its encoded payload is
+    held in memory; it is read in chunks of chunk_size bytes, a multiple
+    of the 57 bytes encoded per line, so that the raw content is not
+    held whole as well. Text attachments are sent as DEFAULT_CHARSET.
+    Prepared parts are returned as is.
+    """
+    if isinstance(attachment, MIMEBase):
+        return attachment
+
+    if isinstance(attachment, basestring):
+        source = open(attachment, 'rb')
+    else:
+        source = attachment
+    try:
+        name = os.path.basename(source.name)
+        encoded = []
+        pending = ''
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            pending += chunk
+            size = len(pending) - len(pending) % 57
+            encoded.append(base64.encodestring(pending[:size]))
+            pending = pending[size:]
+        if pending:
+            encoded.append(base64.encodestring(pending))
+    finally:
+        if source is not attachment:
+            source.close()
+
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    main_type, sub_type = mimetype.split('/', 1)
+    part = MIMEBase(main_type, sub_type)
+    if main_type == 'text':
+        part.set_param('charset', settings.DEFAULT_CHARSET)
+    part.set_payload(''.join(encoded))
+    part['Content-Transfer-Encoding'] = 'base64'
+    part.add_header('Content-Disposition', 'attachment', filename=name)
+
+    return part
+
 def send_messages(messages):
     """Bulk send the message(s)."""
 
@@ -52,52 +196,37 @@ def render_content(subject, text_content, html_content=None,
 
     if context is None:
         context = {}
-    try:
-        subject = render_to_string(subject, context)
-    except TemplateDoesNotExist:
-        if apply_context_to_string:
-            subject = core_utils.render_string_to_string(subject, context)
-
-    try:
-        text_content = render_to_string(text_content, context)
-    except TemplateDoesNotExist:
-        if apply_context_to_string:
-            text_content = core_utils\
-                    .render_string_to_string(text_content, context)
 
-    if html_content is not None:
-        try:
-            html_content = render_to_string(html_content, context)
-        except TemplateDoesNotExist:
-            if apply_context_to_string:
-                html_content = core_utils\
-                        .render_string_to_string(html_content, context)
+    rendered = []
+    for content in (subject, text_content, html_content):
+        template = compile_content(content, apply_context_to_string)
+        if template is not None:
+            content = template.render(Context(context))
+        rendered.append(content)
 
-    return subject, text_content, html_content
+    return tuple(rendered)
 
 def create_message(subject, text_content, to_addresses,
-                   from_address=settings.DEFAULT_FROM_EMAIL,
-                   bcc_addresses=None, html_content=None, context=None,
-                   attachments=None, user=None, apply_context_to_string=False
+                   from_address=None, bcc_addresses=None, html_content=None,
+                   context=None, attachments=None, user=None,
+                   apply_context_to_string=False, environment=None
     ):
-    """Create and return the Email message to be sent."""
+    """
+    Create and return the Email message to be sent. Pass an environment
+    to build many messages with the same site and settings.
+    """
+    if environment is None:
+        environment = MailEnvironment()
 
     # Update context with site and STATIC_URL
     if context is None:
         context = {}
-    if not 'site' in context:
-        context['site'] = Site.objects.get_current()
-    if not 'user' in context:
-        context['user'] = user
-
-    context.update({
-        'STATIC_URL': settings.STATIC_URL,
-        'app_name': settings.APP_NAME
-    })
+    environment.update_context(context, user)
 
     # Check if the content is actual content or a location to a file
     # containing the content and render the content from that file
     # if it is
+    render_started = time.time()
     subject, text_content, html_content = render_content(
         subject,
         text_content,
@@ -105,52 +234,66 @@ def create_message(subject, text_content, to_addresses,
         context,
         apply_context_to_string
     )
-
-    # Update BCC list with extras from settings, if any
-    extra_bccers = getattr(settings, 'EMAIL_EXTRA_BCC_LIST', [])
-    if bcc_addresses:
-        bcc_addresses = bcc_addresses + extra_bccers
-    else:
-        bcc_addresses = extra_bccers
+    render_time = time.time() - render_started
 
     # Build message with text_message as default content
     msg = EmailMultiAlternatives(
         subject,
         text_content,
-        from_address,
+        from_address or environment.from_address,
         to_addresses,
-        bcc_addresses
+        environment.get_bcc_addresses(bcc_addresses)
     )
 
     # Attach HTML content
     if html_content is not None:
         msg.attach_alternative(html_content, "text/html")
 
-    # Add attachments.
+    # Add attachments, which may have been prepared for several messages
     if attachments is not None:
         for attachment in attachments:
             if attachment:
-                msg.attach(attachment.name, attachment.read())
+                msg.attach(prepare_attachment(attachment))
+
+    signals.message_rendered.send(
+        sender=create_message,
+        message=msg,
+        render_time=render_time
+    )
+    logger.debug('Rendered message in %.3fs' % render_time)
 
     return msg, context
 
+def get_html_content(message):
+    """Return the html alternative of a message, if any."""
+
+    for content, mimetype in getattr(message, 'alternatives', []):
+        if mimetype == 'text/html':
+            return content
+
+    return None
+
 def save_outbound_emails(outbound_emails):
-    """Bulk create Outbound Email tracking objects."""
+    """Create Outbound Email tracking objects and their recipients."""
 
     if settings.EMAIL_ENABLED:
-        models.OutboundEmail.objects.bulk_create(outbound_emails)
+        models.OutboundEmail.objects.save_with_recipients(outbound_emails)
 
 def create_outbound_email(subject, to_addresses, html_content,
                           bcc_addresses=None, site=None, user=None):
-    """Create Outbound Email tracking object."""
-
+    """
+    Create Outbound Email tracking object. Its html content is stored
+    once for all the emails with the same content when it is saved.
+    """
     return models.OutboundEmail(
         user=user,
         to_addresses='\n'.join(to_addresses),
         bcc_addresses='\n'.join(bcc_addresses) \
             if bcc_addresses is not None else '',
         subject=subject,
-        message=html_content,
+        body=models.MessageBody(content=html_content) \
+            if html_content else None,
+        bucket=models.get_bucket(timezone.now()),
         site=site
     )
 
@@ -167,18 +310,25 @@ def track_mail(subject, to_addresses, html_content,
             site,
             user
         )
-        outbound_email.save()
+        models.OutboundEmail.objects.save_with_recipients([outbound_email])
 
-def send_mail(subject, text_content, to_addresses,
-              from_address=settings.DEFAULT_FROM_EMAIL, bcc_addresses=None,
-              html_content=None, context=None, attachments=None, user=None,
-              apply_context_to_string=False):
+def send_mail(subject, text_content, to_addresses, from_address=None,
+              bcc_addresses=None, html_content=None, context=None,
+              attachments=None, user=None, apply_context_to_string=False,
+              queued=None, environment=None):
     """
     Sends an email containing both text(provided) and html(produced from
     povided template name and context) content as well as provided
     attachments to provided to_addresses from provided from_address
 
+    When queued (EMAIL_QUEUED by default) the rendered email is stored as
+    a pending OutboundEmail and sent by a Celery worker instead. Emails
+    with attachments are always sent immediately.
+
     """
+    if queued is None:
+        queued = getattr(settings, 'EMAIL_QUEUED', False)
+
     # Create the message
     message, context = create_message(
         subject,
@@ -190,30 +340,293 @@ def send_mail(subject, text_content, to_addresses,
         context,
         attachments,
         user,
-        apply_context_to_string
+        apply_context_to_string,
+        environment
     )
 
+    if queued and not attachments:
+        queue_message(message, context['site'], user)
+        return
+
     # Send the message
     send_messages([message])
 
-    # Check if the content is actual content or a location to a file
-    # containing the content and render the content from that file
-    # if it is
-    subject, text_content, html_content = render_content(
-        subject,
-        text_content,
-        html_content,
-        context,
-        apply_context_to_string
-    )
-
     # Create an entry in the email tracker to
-    # track sent emails by the system
+    # track sent emails by the system, reusing the content
+    # rendered for the message
     track_mail(
-        subject,
+        message.subject,
         to_addresses,
-        html_content,
+        get_html_content(message),
         bcc_addresses,
         context['site'],
         user
     )
+
+def queue_message(message, site=None, user=None):
+    """
+    Store a rendered message as a pending Outbound Email and wake up
+    a worker to send it, unless one is already due to run. Emails queued
+    in a transaction that commits after the worker looked are sent by the
+    periodic run of tasks.send_queued_mail.
+    """
+    if not settings.EMAIL_ENABLED:
+        logger.debug(
+                "Not queueing mail because setting 'EMAIL_ENABLED' is False"
+        )
+        return
+
+    outbound_email = create_outbound_email(
+        message.subject,
+        message.to,
+        get_html_content(message),
+        message.bcc,
+        site,
+        user
+    )
+    outbound_email.from_address = message.from_email
+    outbound_email.text_content = message.body
+    outbound_email.status = constants.STATUS_PENDING
+    models.OutboundEmail.objects.save_with_recipients([outbound_email])
+    models.OutboundEmail.objects.wake_up_at(timezone.now())
+
+    return outbound_email
+
+def _claim_queued_mail(batch_size):
+    """
+    Claim a batch of due Outbound Emails for this worker. Claimed emails
+    are leased for EMAIL_QUEUE_LEASE seconds, after which an email whose
+    worker died is claimed again.
+    """
+    now = timezone.now()
+    lease = getattr(settings, 'EMAIL_QUEUE_LEASE', 60 * 10)
+
+    with transaction.atomic():
+        pks = list(
+            models.OutboundEmail.objects.select_for_update().filter(
+                status__in=(
+                    constants.STATUS_PENDING,
+                    constants.STATUS_SENDING
+                )
+            ).filter(
+                Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now)
+            ).order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        models.OutboundEmail.objects.filter(pk__in=pks).update(
+            status=constants.STATUS_SENDING,
+            next_attempt_at=now + timedelta(seconds=lease)
+        )
+
+    # Retry the batch should this worker die before it is sent
+    if pks:
+        models.OutboundEmail.objects.wake_up_at(now + timedelta(seconds=lease))
+
+    return models.OutboundEmail.objects.filter(pk__in=pks).order_by('pk')
+
+def _build_queued_message(outbound_email, connection):
+    """Rebuild the message stored on a queued Outbound Email."""
+
+    msg = EmailMultiAlternatives(
+        outbound_email.subject,
+        outbound_email.text_content,
+        outbound_email.from_address,
+        outbound_email.to_addresses.split('\n'),
+        outbound_email.bcc_addresses.split('\n') \
+            if outbound_email.bcc_addresses else None,
+        connection=connection
+    )
+    html_content = outbound_email.html
+    if html_content:
+        msg.attach_alternative(html_content, "text/html")
+
+    return msg
+
+def send_queued_mail(batch_size=None):
+    """
+    Send a batch of batch_size (EMAIL_BATCH_SIZE, 100 by default) queued
+    emails over a single connection. Emails that fail are retried with
+    an exponential backoff, starting at EMAIL_QUEUE_RETRY_DELAY seconds,
+    until EMAIL_QUEUE_MAX_ATTEMPTS attempts have failed.
+
+    Returns a (sent, failed) tuple with the number of emails of the batch
+    that were sent and that failed.
+
+    """
+    if batch_size is None:
+        batch_size = getattr(settings, 'EMAIL_BATCH_SIZE', 100)
+    retry_delay = getattr(settings, 'EMAIL_QUEUE_RETRY_DELAY', 60)
+    max_attempts = getattr(settings, 'EMAIL_QUEUE_MAX_ATTEMPTS', 5)
+
+    outbound_emails = list(
+        _claim_queued_mail(batch_size).select_related('body')
+    )
+    if not outbound_emails:
+        return 0, 0
+
+    sent_pks = []
+    failed = 0
+    connection = get_connection()
+    try:
+        for outbound_email in outbound_emails:
+            try:
+                _build_queued_message(outbound_email, connection).send()
+            except Exception, e:
+                logger.exception(
+                    'Failed to send queued email %s' % outbound_email.pk
+                )
+                attempts = outbound_email.attempts + 1
+                models.OutboundEmail.objects.filter(
+                    pk=outbound_email.pk
+                ).update(
+                    status=constants.STATUS_FAILED \
+                        if attempts >= max_attempts \
+                        else constants.STATUS_PENDING,
+                    attempts=attempts,
+                    last_error=unicode(e),
+                    next_attempt_at=timezone.now() + timedelta(
+                        seconds=retry_delay * 2 ** (attempts - 1)
+                    )
+                )
+                failed += 1
+            else:
+                sent_pks.append(outbound_email.pk)
+    finally:
+        connection.close()
+
+    models.OutboundEmail.objects.filter(pk__in=sent_pks).update(
+        status=constants.STATUS_SENT,
+        attempts=F('attempts') + 1,
+        sent_timestamp=timezone.now(),
+        next_attempt_at=None
+    )
+
+    return len(sent_pks), failed
+
+def compile_content(content, apply_context_to_string=False):
+    """
+    Compile content that is either the name of a template or, when
+    apply_context_to_string is True, a template string. Return None if
+    the content is literal content that is used as is. Content marked as
+    a TemplateName or TemplateString is never looked up in the other way.
+    """
+    if content is None:
+        return None
+    if isinstance(content, TemplateName):
+        return get_template(content)
+    if not isinstance(content, TemplateString):
+        template = resolve_template(content)
+        if template is not None:
+            return template
+    if apply_context_to_string:
+        return core_utils.get_string_template(content)
+
+    return None
+
+def send_mass_mail(subject, text_content, recipients, from_address=None,
+                   html_content=None, attachments=None,
+                   apply_context_to_string=False, chunk_size=None,
+                   environment=None):
+    """
+    Sends a personalised email to each of the provided recipients, an
+    iterable of (to_addresses, context) pairs whose contexts may hold a
+    'user'. The subject, text and html content are compiled once and
+    rendered per recipient as the iterable is consumed. Messages are sent
+    over a single connection and tracked with one bulk insert per chunk
+    of chunk_size (EMAIL_BATCH_SIZE, 100 by default) messages.
+
+    Returns the number of messages sent.
+
+    """
+    if chunk_size is None:
+        chunk_size = getattr(settings, 'EMAIL_BATCH_SIZE', 100)
+
+    templates = [
+        compile_content(content, apply_context_to_string)
+        for content in (subject, text_content, html_content)
+    ]
+    if attachments is not None:
+        attachments = [
+            prepare_attachment(attachment)
+            for attachment in attachments if attachment
+        ]
+    if environment is None:
+        environment = MailEnvironment()
+    from_address = from_address or environment.from_address
+
+    connection = None
+    if settings.EMAIL_ENABLED:
+        connection = get_connection()
+        connection.open()
+    else:
+        logger.debug(
+                "Not sending mail because setting 'EMAIL_ENABLED' is False"
+        )
+
+    sent = 0
+    messages = []
+    outbound_emails = []
+    try:
+        for to_addresses, context in recipients:
+            context = environment.update_context(dict(context or {}))
+
+            render_started = time.time()
+            template_context = Context(context)
+            rendered = [
+                template.render(template_context)
+                if template is not None else content
+                for template, content in zip(
+                    templates, (subject, text_content, html_content)
+                )
+            ]
+            render_time = time.time() - render_started
+
+            msg = EmailMultiAlternatives(
+                rendered[0],
+                rendered[1],
+                from_address,
+                to_addresses,
+                environment.extra_bcc,
+                connection=connection
+            )
+            if rendered[2] is not None:
+                msg.attach_alternative(rendered[2], "text/html")
+            if attachments is not None:
+                for attachment in attachments:
+                    msg.attach(attachment)
+
+            signals.message_rendered.send(
+                sender=send_mass_mail,
+                message=msg,
+                render_time=render_time
+            )
+
+            messages.append(msg)
+            outbound_emails.append(create_outbound_email(
+                rendered[0],
+                to_addresses,
+                rendered[2],
+                site=context['site'],
+                user=context['user']
+            ))
+
+            if len(messages) >= chunk_size:
+                sent += _send_chunk(connection, messages, outbound_emails)
+                messages = []
+                outbound_emails = []
+
+        if messages:
+            sent += _send_chunk(connection, messages, outbound_emails)
+    finally:
+        if connection is not None:
+            connection.close()
+
+    return sent
+
+def _send_chunk(connection, messages, outbound_emails):
+    """Send a chunk of messages and track them with one bulk insert."""
+
+    if connection is not None:
+        connection.send_messages(messages)
+    save_outbound_emails(outbound_emails)
+
+    return len(messages)
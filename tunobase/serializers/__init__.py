@@ -1 +1,31 @@
+"""
+Serializers with streaming, compact JSON and MessagePack formats.
+
+Django only finds the formats once they are registered. Either add them
+to the project settings:
+
+    from tunobase.serializers import SERIALIZATION_MODULES
+
+or call ``register_serializers()`` once Django is set up, for example
+from the models module of an installed app.
+"""
 __version__ = '1.1.0'
+
+# Formats to register with Django's serializer registry
+SERIALIZATION_MODULES = {
+    'tunobase_json': 'tunobase.serializers.json',
+    'compact_json': 'tunobase.serializers.compact_json',
+    'msgpack': 'tunobase.serializers.compact_msgpack',
+}
+
+
+def register_serializers():
+    """
+    Register the tunobase formats with Django's serializer registry, so
+    that ``django.core.serializers.serialize('compact_json', queryset)``
+    can use them.
+    """
+    from django.core import serializers
+
+    for format, module in SERIALIZATION_MODULES.items():
+        serializers.register_serializer(format, module)
@@ -22,6 +22,7 @@ class Serializer(base.Serializer):
         self.extras = None
         self.use_natural_keys = None
         self.fields_only = None
+        self._plans = {}
         super(Serializer, self).__init__(*args, **kwargs)
 
     def serialize(self, queryset, **options):
@@ -33,6 +34,42 @@ class Serializer(base.Serializer):
             extras - list of attributes and methods to include.
                 Methods cannot take arguments.
         """
+        self.configure(options)
+        queryset = self.prepare_queryset(queryset)
+
+        self.start_serialization()
+
+        try:
+            objects = iter(queryset)
+            qs = True
+        except TypeError:
+            # A single model instance
+            objects = [queryset]
+            qs = False
+
+        for obj in objects:
+            self.serialize_object(obj)
+
+        self.end_serialization(qs)
+        return self.getvalue()
+
+    def serialize_object(self, obj):
+        """Serialize a single object with the field plan of its model."""
+        plan = self._plans.get(obj.__class__)
+        if plan is None:
+            plan = self._plans[obj.__class__] = self.get_field_plan(obj._meta)
+
+        self.start_object(obj)
+        for handler, field in plan:
+            handler(obj, field)
+        for extra in self.extras:
+            self.handle_extra_field(obj, extra)
+        self.end_object(obj)
+
+    def configure(self, options):
+        """Set the serialization options, leaving the options that are
+        not the serializer's own in ``self.options``.
+        """
         self.options = options
         self.stream = options.pop("stream", StringIO())
         self.fields = options.pop("fields", [])
@@ -41,60 +78,37 @@ class Serializer(base.Serializer):
         self.extras = options.pop("extras", [])
         self.use_natural_keys = options.pop("use_natural_keys", False)
         self.fields_only = options.pop("fields_only", False)
+        self._plans = {}
 
-        self.start_serialization()
+    def prepare_queryset(self, queryset):
+        """Return the queryset (or object) to serialize."""
+        return queryset
 
-        try:
-            qs = True
-            for obj in queryset:
-                self.start_object(obj)
-                for field in obj._meta.local_fields:
-                    attname = field.attname
-                    if field.serialize or 'ptr' in attname:
-                        if field.rel is None:
-                            if attname not in self.excludes:
-                                if not self.fields or attname in self.fields:
-                                    self.handle_field(obj, field)
-                        else:
-                            if attname[:-3] not in self.excludes:
-                                if not self.fields \
-                                        or attname[:-3] in self.fields:
-                                    self.handle_fk_field(obj, field)
-                for field in obj._meta.many_to_many:
-                    if field.serialize:
-                        if field.attname not in self.excludes:
-                            if not self.fields \
-                                    or field.attname in self.fields:
-                                self.handle_m2m_field(obj, field)
-                for extra in self.extras:
-                    self.handle_extra_field(obj, extra)
-                self.end_object(obj)
-        except TypeError as inst:
-            qs = False
-            obj = queryset
-            self.start_object(obj)
-            for field in obj._meta.local_fields:
-                attname = field.attname
-                if field.serialize or 'ptr' in attname:
-                    if field.rel is None:
-                        if attname not in self.excludes:
-                            if not self.fields or attname in self.fields:
-                                self.handle_field(obj, field)
-                    else:
-                        if attname[:-3] not in self.excludes:
-                            if not self.fields or attname[:-3] in self.fields:
-                                self.handle_fk_field(obj, field)
-            for field in obj._meta.many_to_many:
-                if field.serialize:
-                    if field.attname not in self.excludes:
-                        if not self.fields or field.attname in self.fields:
-                            self.handle_m2m_field(obj, field)
-            for extra in self.extras:
-                self.handle_extra_field(obj, extra)
-            self.end_object(obj)
+    def get_field_plan(self, opts):
+        """Return the ordered (handler, field) pairs to serialize a model
+        with, leaving out the fields that are not serialized, excluded or
+        not in ``fields``.
+        """
+        fields = set(self.fields)
+        excludes = set(self.excludes)
 
-        self.end_serialization(qs)
-        return self.getvalue()
+        def include(name):
+            return name not in excludes and (not fields or name in fields)
+
+        plan = []
+        for field in opts.local_fields:
+            attname = field.attname
+            if field.serialize or 'ptr' in attname:
+                if field.rel is None:
+                    if include(attname):
+                        plan.append((self.handle_field, field))
+                elif include(attname[:-3]):
+                    plan.append((self.handle_fk_field, field))
+        for field in opts.many_to_many:
+            if field.serialize and include(field.attname):
+                plan.append((self.handle_m2m_field, field))
+
+        return tuple(plan)
 
     def handle_extra_field(self, obj, extra):
         """Called to handle 'extras' field serialization."""
@@ -0,0 +1,116 @@
+"""
+Compact tabular serializer for Django.
+
+Objects are serialized to a list of rows. A header row, a mapping of
+"model" to the model label and "columns" to the column names, is written
+first and again whenever the model or the columns of the objects change,
+as when ``dumpdata`` serializes several models in one call. Every other
+row holds the values of one object in the order of the last header. The
+primary key is the first column unless ``fields_only`` is set, and the
+"extras" column is last when ``extras`` are requested.
+"""
+from django.db.models.query import QuerySet
+from django.utils.encoding import smart_unicode
+from django.core.serializers.base import DeserializationError
+from django.core.serializers.python import Deserializer as PythonDeserializer
+
+from python import Serializer as PythonSerializer
+
+class Serializer(PythonSerializer):
+    """
+    Convert a queryset to header rows and one row per object.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Initialize instance attributes."""
+        self.rows = []
+        self._label = None
+        self._header_label = None
+        self._header_keys = None
+        self._header_columns = None
+        super(Serializer, self).__init__(*args, **kwargs)
+
+    def prepare_queryset(self, queryset):
+        """Remember the model of a queryset for the header row."""
+        self._label = None
+        if isinstance(queryset, QuerySet):
+            self._label = smart_unicode(queryset.model._meta)
+
+        return super(Serializer, self).prepare_queryset(queryset)
+
+    def start_serialization(self):
+        """Start without a header row."""
+        super(Serializer, self).start_serialization()
+        self.rows = []
+        self._header_label = None
+        self._header_keys = None
+        self._header_columns = None
+
+    def end_object(self, obj):
+        """
+        Turn the serialized object into a row, after a new header row if
+        its model or columns differ from those of the previous object.
+        """
+        super(Serializer, self).end_object(obj)
+        data = self.objects.pop()
+
+        if self.fields_only:
+            values = dict(data)
+        else:
+            values = dict(data["fields"], pk=data["pk"])
+            if "extras" in data:
+                values["extras"] = data["extras"]
+
+        if hasattr(obj, '_meta'):
+            label = smart_unicode(obj._meta)
+        else:
+            label = self._label
+        keys = set(values)
+        keys.discard("extras")
+        if label != self._header_label or keys != self._header_keys:
+            self._header_label = label
+            self._header_keys = keys
+            self._header_columns = sorted(keys - set(["pk"]))
+            if not self.fields_only:
+                self._header_columns.insert(0, "pk")
+            if self.extras:
+                self._header_columns.append("extras")
+            self.rows.append({
+                "model": label,
+                "columns": self._header_columns,
+            })
+
+        self.rows.append([
+            values.get(column) for column in self._header_columns
+        ])
+
+    def getvalue(self):
+        """Return the rows."""
+        return self.rows
+
+
+def get_objects(rows):
+    """
+    Yield the rows of a compact payload as the dictionaries Django's
+    Python deserializer reads. Extras are left out.
+    """
+    label = columns = None
+    for row in rows:
+        if isinstance(row, dict):
+            label, columns = row["model"], row["columns"]
+            continue
+        if columns is None:
+            raise DeserializationError("Compact row without a header row")
+
+        fields = dict(zip(columns, row))
+        fields.pop("extras", None)
+        pk = fields.pop("pk", None)
+        yield {"model": label, "pk": pk, "fields": fields}
+
+
+def Deserializer(object_list, **options):
+    """
+    Deserialize compact rows back into Django ORM instances. Relations
+    must have been serialized as keys, as with Django's serializers.
+    """
+    return PythonDeserializer(get_objects(object_list), **options)
@@ -0,0 +1,43 @@
+"""
+Serialize data to/from compact JSON: an array of header objects and
+value arrays, see ``compact``.
+"""
+from django.utils import simplejson
+from django.core.serializers.base import DeserializationError
+from django.core.serializers.json import DjangoJSONEncoder
+
+from compact import Serializer as CompactSerializer, \
+    Deserializer as CompactDeserializer
+
+class Serializer(CompactSerializer):
+    """
+    Convert a queryset to compact JSON.
+    """
+    def end_serialization(self, qs):
+        """Output the JSON encoded rows without whitespace."""
+
+        options = dict(self.options)
+        options.setdefault('separators', (',', ':'))
+        simplejson.dump(self.rows, self.stream, cls=DjangoJSONEncoder,
+            **options)
+
+    def getvalue(self):
+        """
+        Return the fully serialized queryset (or None if the output stream
+        is not seekable).
+        """
+
+        if callable(getattr(self.stream, 'getvalue', None)):
+            return self.stream.getvalue()
+
+def Deserializer(stream_or_string, **options):
+    """Deserialize a stream or string of compact JSON."""
+
+    if not isinstance(stream_or_string, basestring):
+        stream_or_string = stream_or_string.read()
+    try:
+        rows = simplejson.loads(stream_or_string)
+    except Exception, e:
+        raise DeserializationError(e)
+
+    return CompactDeserializer(rows, **options)
@@ -0,0 +1,64 @@
+"""
+Serialize data to/from MessagePack, using the rows of ``compact``.
+
+Requires the msgpack package.
+"""
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.base import DeserializationError
+from django.core.serializers.json import DjangoJSONEncoder
+
+from compact import Serializer as CompactSerializer, \
+    Deserializer as CompactDeserializer
+
+def check_msgpack():
+    """Raise ImproperlyConfigured if msgpack is not installed."""
+
+    if msgpack is None:
+        raise ImproperlyConfigured(
+            'The msgpack package is required to serialize to MessagePack'
+        )
+
+class Serializer(CompactSerializer):
+    """
+    Convert a queryset to MessagePack. Values MessagePack has no type for,
+    like dates and decimals, are encoded as they are in JSON.
+    """
+    def end_serialization(self, qs):
+        """Output the MessagePack encoded rows."""
+
+        check_msgpack()
+        self.stream.write(msgpack.packb(
+            self.rows,
+            default=DjangoJSONEncoder().default
+        ))
+
+    def getvalue(self):
+        """
+        Return the fully serialized queryset (or None if the output stream
+        is not seekable).
+        """
+
+        if callable(getattr(self.stream, 'getvalue', None)):
+            return self.stream.getvalue()
+
+def Deserializer(stream_or_string, **options):
+    """Deserialize a stream or string of MessagePack."""
+
+    check_msgpack()
+    if not isinstance(stream_or_string, basestring):
+        stream_or_string = stream_or_string.read()
+    try:
+        try:
+            rows = msgpack.unpackb(stream_or_string, raw=False)
+        except TypeError:
+            # msgpack < 0.5.2
+            rows = msgpack.unpackb(stream_or_string, encoding='utf-8')
+    except Exception, e:
+        raise DeserializationError(e)
+
+    return CompactDeserializer(rows, **options)
@@ -1,6 +1,7 @@
 """
 Serialize data to/from JSON
 """
+from django.db.models.query import QuerySet
 from django.utils import simplejson
 from python import Serializer as PythonSerializer
 from django.core.serializers.json import Deserializer as JSONDeserializer, \
@@ -10,16 +11,173 @@ class Serializer(PythonSerializer):
     """
     Convert a queryset to JSON.
     """
+    def __init__(self, *args, **kwargs):
+        """Initialize instance attributes."""
+        self.streaming = False
+        self.json_lines = False
+        self.chunk_size = None
+        self._pending = None
+        self._written = 0
+        super(Serializer, self).__init__(*args, **kwargs)
+
+    def serialize(self, queryset, **options):
+        """Serialize a queryset with the JSON specific options:
+            streaming - write each object to the stream as soon as it is
+                serialized instead of holding all of them in memory.
+                Querysets are read with ``iterator()``.
+            json_lines - stream one JSON object per line instead of a
+                JSON array.
+            chunk_size - number of objects to read at a time when streaming
+                a queryset with prefetched relations, which ``iterator()``
+                would ignore. Defaults to 1000.
+        """
+        self.json_lines = options.pop("json_lines", False)
+        self.streaming = options.pop("streaming", False) or self.json_lines
+        self.chunk_size = options.pop("chunk_size", 1000)
+
+        return super(Serializer, self).serialize(queryset, **options)
+
+    def prepare_queryset(self, queryset):
+        """When streaming, read querysets without caching their objects."""
+
+        queryset = super(Serializer, self).prepare_queryset(queryset)
+        if self.streaming and isinstance(queryset, QuerySet):
+            if queryset._prefetch_related_lookups:
+                return self._iterate_in_chunks(queryset)
+            return queryset.iterator()
+
+        return queryset
+
+    def _iterate_in_chunks(self, queryset):
+        """
+        Read a queryset a chunk of objects at a time. Querysets that are
+        ordered by primary key, or not ordered, are paged by primary key
+        so that every chunk is found through the index. Other orderings
+        are paged with OFFSET, ordered by primary key last so that objects
+        that sort equally are not repeated or skipped across chunks.
+        Sliced querysets are read whole.
+        """
+        if queryset.query.low_mark or queryset.query.high_mark is not None:
+            for obj in queryset:
+                yield obj
+            return
+
+        descending = self._get_pk_ordering(queryset)
+        if descending is None:
+            ordering = self._get_ordering(queryset) + ['pk']
+            if queryset.query.extra_order_by:
+                queryset = queryset.extra(order_by=ordering)
+            else:
+                queryset = queryset.order_by(*ordering)
+            start = 0
+            while True:
+                chunk = list(queryset[start:start + self.chunk_size])
+                for obj in chunk:
+                    yield obj
+                if len(chunk) < self.chunk_size:
+                    break
+                start += self.chunk_size
+            return
+
+        if not queryset.ordered:
+            queryset = queryset.order_by('pk')
+        lookup = 'pk__lt' if descending else 'pk__gt'
+        chunk = list(queryset[:self.chunk_size])
+        while chunk:
+            for obj in chunk:
+                yield obj
+            if len(chunk) < self.chunk_size:
+                break
+            chunk = list(
+                queryset.filter(**{lookup: chunk[-1].pk})[:self.chunk_size]
+            )
+
+    def _get_pk_ordering(self, queryset):
+        """
+        Return whether a queryset is ordered by descending primary key,
+        False if it is not ordered at all, or None if it is ordered by
+        anything else.
+        """
+        if queryset.query.extra_order_by:
+            return None
+
+        ordering = self._get_ordering(queryset)
+        if not ordering:
+            return False
+        pk = queryset.model._meta.pk
+        if len(ordering) == 1 and \
+                ordering[0].lstrip('-') in ('pk', pk.name, pk.attname):
+            return ordering[0].startswith('-')
+
+        return None
+
+    def _get_ordering(self, queryset):
+        """Return the ordering a queryset is read in."""
+
+        query = queryset.query
+        if query.extra_order_by:
+            return list(query.extra_order_by)
+        if query.order_by:
+            return list(query.order_by)
+        if query.default_ordering:
+            return list(queryset.model._meta.ordering)
+        return []
+
+    def start_serialization(self):
+        """Start without any object written to the stream."""
+
+        super(Serializer, self).start_serialization()
+        self._pending = None
+        self._written = 0
+
+    def end_object(self, obj):
+        """
+        When streaming, write the previous object to the stream. One object
+        is held back until the end so that a single object that is not part
+        of a queryset can be written on its own.
+        """
+        super(Serializer, self).end_object(obj)
+
+        if self.streaming:
+            if self._pending is not None:
+                self._write_object(self._pending)
+            self._pending = self.objects.pop()
+
     def end_serialization(self, qs):
         """Output a JSON encoded queryset."""
 
-        if not qs:
+        if self.streaming:
+            if not qs:
+                self._dump(self._pending)
+                if self.json_lines:
+                    self.stream.write('\n')
+                return
+            if self._pending is not None:
+                self._write_object(self._pending)
+            if not self.json_lines:
+                self.stream.write(']' if self._written else '[]')
+        elif not qs:
             simplejson.dump(self.objects[0], self.stream,
                     cls=DjangoJSONEncoder, **self.options)
         else:
             simplejson.dump(self.objects, self.stream, cls=DjangoJSONEncoder,
                 **self.options)
 
+    def _write_object(self, data):
+        """Write one object of a streamed queryset."""
+
+        if self.json_lines:
+            self._dump(data)
+            self.stream.write('\n')
+        else:
+            self.stream.write(', ' if self._written else '[')
+            self._dump(data)
+        self._written += 1
+
+    def _dump(self, data):
+        simplejson.dump(data, self.stream, cls=DjangoJSONEncoder,
+            **self.options)
+
     def getvalue(self):
         """
         Return the fully serialized queryset (or None if the output stream
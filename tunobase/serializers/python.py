@@ -1,10 +1,40 @@
 """
 Full Python serializer for Django.
 """
+import copy
+from collections import OrderedDict
+
 import base
+from django.db.models import fields as model_fields
+from django.db.models.fields.subclassing import SubfieldBase
+from django.db.models.query import QuerySet
 from django.utils.encoding import smart_unicode, is_protected_type
 from django.core.serializers.python import Deserializer as PythonDeserializer
 
+# value_to_string() implementations that only differ from converting the
+# column value to unicode for values that are protected types anyway
+PLAIN_VALUE_TO_STRING = frozenset(
+    field_class.value_to_string.__func__ for field_class in (
+        model_fields.Field,
+        model_fields.DateField,
+        model_fields.DateTimeField,
+        model_fields.TimeField
+    )
+)
+
+
+def to_unicode(value):
+    """Convert a column value the way handle_field converts a field."""
+    if is_protected_type(value):
+        return value
+    return smart_unicode(value)
+
+
+def fk_to_unicode(value):
+    """Convert a foreign key to a field other than the primary key."""
+    return smart_unicode(value, strings_only=True)
+
+
 class Serializer(base.Serializer):
     """
     Python serializer for Django modelled after Ruby on Rails.
@@ -13,21 +43,168 @@ class Serializer(base.Serializer):
     ``relations`` argument.
     """
 
+    # Number of serialized related objects each relation remembers
+    related_cache_size = 1000
+
     def __init__(self, *args, **kwargs):
         """
         Initialize instance attributes.
         """
         self._fields = None
         self._extras = None
+        self._children = {}
+        self._serialized = OrderedDict()
+        self._columns = None
         self.objects = []
         super(Serializer, self).__init__(*args, **kwargs)
 
+    def prepare_queryset(self, queryset):
+        """
+        Select or prefetch the relations that will be serialized along
+        with the objects of a queryset, or read only the values of the
+        serialized columns when no model instance is needed.
+        """
+        self._columns = None
+        if isinstance(queryset, QuerySet):
+            columns = self.get_columns(queryset.model._meta)
+            if columns is not None:
+                self._columns = columns
+                return queryset.values_list(
+                    *[field.attname for field, name, convert in columns])
+
+            select, prefetch = self.get_related_lookups(queryset.model._meta)
+            if select:
+                queryset = queryset.select_related(*select)
+            if prefetch:
+                queryset = queryset.prefetch_related(*prefetch)
+
+        return queryset
+
+    def get_columns(self, opts):
+        """
+        Return the (field, name, converter) columns to serialize a model
+        from its values, or None if serializing it needs model instances:
+        when full objects, extras, relations, many to many values, natural
+        keys or fields with their own conversions are serialized.
+        """
+        if not self.fields_only or self.extras:
+            return None
+
+        columns = []
+        for handler, field in self.get_field_plan(opts):
+            if field.rel is None:
+                if isinstance(type(field), SubfieldBase) \
+                        or type(field).value_to_string.__func__ \
+                        not in PLAIN_VALUE_TO_STRING:
+                    return None
+                columns.append((field, field.name, to_unicode))
+            elif field in opts.many_to_many or field.name in self.relations \
+                    or (self.use_natural_keys
+                        and hasattr(field.rel.to, 'natural_key')):
+                return None
+            elif field.rel.field_name != field.rel.to._meta.pk.name:
+                columns.append((field, field.name, fk_to_unicode))
+            else:
+                columns.append((field, field.name, None))
+
+        return tuple(columns)
+
+    def serialize_object(self, obj):
+        """Serialize a model instance, or the values read for one."""
+        if self._columns is None:
+            return super(Serializer, self).serialize_object(obj)
+
+        self.start_object(obj)
+        for (field, name, convert), value in zip(self._columns, obj):
+            self._fields[name] = value if convert is None else convert(value)
+        self.end_object(obj)
+
+    def get_related_lookups(self, opts, prefix='', prefetch=False):
+        """
+        Return the (select_related, prefetch_related) lookups needed to
+        serialize objects of a model, following nested relations. Below
+        a many to many relation every lookup has to be prefetched.
+        """
+        select = []
+        prefetched = []
+        for handler, field in self.get_field_plan(opts):
+            if field.rel is None:
+                continue
+            fname = field.name
+            lookup = prefix + fname
+            many = field in opts.many_to_many
+            if many and not field.rel.through._meta.auto_created:
+                continue
+
+            if fname in self.relations:
+                (prefetched if prefetch or many else select).append(lookup)
+                child = Serializer()
+                child.configure(self.get_relation_options(fname))
+                child_select, child_prefetch = child.get_related_lookups(
+                    field.rel.to._meta, lookup + '__', prefetch or many)
+                select.extend(child_select)
+                prefetched.extend(child_prefetch)
+            elif many:
+                prefetched.append(lookup)
+            elif self.use_natural_keys and hasattr(field.rel.to, 'natural_key'):
+                (prefetched if prefetch else select).append(lookup)
+
+        return select, prefetched
+
+    def get_relation_options(self, fname):
+        """
+        Return the options to fully serialize the related objects of the
+        relation fname with.
+        """
+        options = {'fields_only': self.fields_only,
+                   'fields': self.fields,
+                   'excludes': self.excludes}
+        if isinstance(self.relations, dict):
+            if isinstance(self.relations[fname], dict):
+                options = dict(self.relations[fname])
+
+        return options
+
+    def get_child(self, fname):
+        """
+        Return the serializer that fully serializes the related objects of
+        the relation fname, shared by every object serialized in this call.
+        """
+        child = self._children.get(fname)
+        if child is None:
+            child = self._children[fname] = Serializer()
+            child.configure(self.get_relation_options(fname))
+            child.start_serialization()
+
+        return child
+
+    def serialize_related(self, related):
+        """
+        Return the serialized form of a related object. The forms of the
+        related_cache_size objects used most recently are kept, so that an
+        object many objects point to is serialized once while memory stays
+        bounded when streaming. Each object that points to the related
+        object gets its own copy of the form, so that it can be modified.
+        """
+        key = (related.__class__, related._get_pk_val())
+        data = self._serialized.pop(key, None)
+        if data is None:
+            self.serialize_object(related)
+            data = self.objects.pop()
+            if len(self._serialized) >= self.related_cache_size:
+                self._serialized.popitem(last=False)
+        self._serialized[key] = data
+
+        return copy.deepcopy(data)
+
     def start_serialization(self):
         """
         Called when serializing of the queryset starts.
         """
         self._fields = None
         self._extras = None
+        self._children = {}
+        self._serialized = OrderedDict()
         self.objects = []
 
     def end_serialization(self, qs):
@@ -80,24 +257,26 @@ class Serializer(base.Serializer):
         Recursively serializes relations specified in the 'relations' option.
         """
         fname = field.name
+        if fname not in self.relations and not (self.use_natural_keys
+                and hasattr(field.rel.to, 'natural_key')):
+            # serialize the value of the related field without fetching
+            # the related object
+            related = getattr(obj, field.attname)
+            if field.rel.field_name != field.rel.to._meta.pk.name:
+                related = smart_unicode(related, strings_only=True)
+            self._fields[fname] = related
+            return
+
         related = getattr(obj, fname)
         if related is not None:
             if fname in self.relations:
                 # perform full serialization of FK
-                serializer = Serializer()
-                options = {'fields_only': self.fields_only,
-                           'fields': self.fields,
-                           'excludes': self.excludes}
-                if isinstance(self.relations, dict):
-                    if isinstance(self.relations[fname], dict):
-                        options = self.relations[fname]
+                serialized = self.get_child(fname).serialize_related(related)
 
                 if 'ptr' in fname:
-                    self._fields.update(serializer.serialize([related],
-                        **options)[0])
+                    self._fields.update(serialized)
                 else:
-                    self._fields[fname] = serializer.serialize([related],
-                        **options)[0]
+                    self._fields[fname] = serialized
             else:
                 # emulate the original behaviour and serialize the pk value
                 if self.use_natural_keys and hasattr(related, 'natural_key'):
@@ -123,16 +302,10 @@ class Serializer(base.Serializer):
             fname = field.name
             if fname in self.relations:
                 # perform full serialization of M2M
-                serializer = Serializer()
-                options = {'fields_only': self.fields_only,
-                           'fields': self.fields,
-                           'excludes': self.excludes}
-                if isinstance(self.relations, dict):
-                    if isinstance(self.relations[fname], dict):
-                        options = self.relations[fname]
+                serializer = self.get_child(fname)
                 self._fields[fname] = [
-                    serializer.serialize([related], **options)[0]
-                       for related in getattr(obj, fname).iterator()]
+                    serializer.serialize_related(related)
+                       for related in getattr(obj, fname).all()]
             else:
                 # emulate the original behaviour and serialize to a list of 
                 # primary key values
@@ -142,7 +315,7 @@ class Serializer(base.Serializer):
                     m2m_value = lambda value: smart_unicode(
                         value._get_pk_val(), strings_only=True)
                 self._fields[fname] = [m2m_value(related)
-                    for related in getattr(obj, fname).iterator()]
+                    for related in getattr(obj, fname).all()]
 
     def getvalue(self):
         """
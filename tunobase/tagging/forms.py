@@ -15,8 +15,8 @@ Created on 29 Oct 2013
 
 """
 from django import forms
-from django.contrib.sites.models import Site
 
+from tunobase.core import sites
 from tunobase.tagging import models
 
 class TagUpdateForm(forms.Form):
@@ -32,7 +32,7 @@ class TagUpdateForm(forms.Form):
 
         """
         tags = set(tags)
-        site = Site.objects.get_current()
+        site = sites.get_current_site()
         content_object_tags = []
 
         # delete all existing tags on the object
@@ -5,10 +5,9 @@ This module provides a series of managers to manage
 the tagging app.
 
 """
-from django.contrib.contenttypes.models import ContentType
 from django.db import models
 
-from tunobase.core import managers as core_managers
+from tunobase.core import content_types, managers as core_managers
 
 class ContentObjectTagManager(models.Manager):
     """Retrieve various information about an objects tags."""
@@ -20,7 +19,7 @@ class ContentObjectTagManager(models.Manager):
                 .get_query_set()\
                 .select_related('tag')\
                 .filter(
-                    content_type=ContentType.objects.get_for_model(obj),
+                    content_type=content_types.get_id_for_model(obj),
                     object_pk=obj.pk,
                     site=site
                 )
@@ -33,8 +32,8 @@ class ContentObjectTagManager(models.Manager):
                 .get_query_set()\
                 .select_related('tag')\
                 .filter(
-                    content_type=ContentType.objects\
-                            .get_by_natural_key(app_label, model),
+                    content_type=content_types\
+                            .get_id_by_natural_key(app_label, model),
                     site=site
                 )
 
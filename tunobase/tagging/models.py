@@ -10,6 +10,7 @@ from django.contrib.sites.models import Site
 from django.core import urlresolvers
 from django.db import models
 
+from tunobase.core import sites
 from tunobase.core.models import SlugModel
 from tunobase.tagging import managers
 
@@ -79,6 +80,6 @@ class ContentObjectTag(BaseTagAbstractModel):
     def save(self, *args, **kwargs):
         """Set the site before saving."""
 
-        if self.site is None:
-            self.site = Site.objects.get_current()
+        if self.site_id is None:
+            self.site = sites.get_current_site()
         super(ContentObjectTag, self).save(*args, **kwargs)